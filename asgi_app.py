@@ -0,0 +1,200 @@
+"""Async server mode for the key validator.
+
+Serves the same POST /validate, GET /health and GET /metrics contract as app.py, but on
+an event loop backed by KeySystem's asyncpg pool. Run it with:
+
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import json
+import time
+
+from key_system import KeySystem, BATCH_MAX_ITEMS
+from notifier import dispatcher_from_env
+from metrics import REGISTRY, CONTENT_TYPE, optional_stats, record_result, register_validation_gauges
+from structured_log import get_logger, log_validation
+from rate_limit import limiter_from_env, merge_batch_results, retry_after_header
+
+DISCORD_CHANNEL_ID = 1442158195824001116
+
+# Keys are created and changed by the bot: follow its key_events to keep the filter and cache current
+key_system = KeySystem(listen=True)
+notifier = dispatcher_from_env(DISCORD_CHANNEL_ID)
+rate_limiter = limiter_from_env()
+log = get_logger('asgi_app')
+
+
+async def _read_json(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return json.loads(body) if body else None
+
+
+async def _send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload, default=str).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            *headers
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _client_ip(scope):
+    forwarded_for = next((value.decode('latin-1') for name, value in scope.get('headers', ())
+                          if name == b'x-forwarded-for'), None)
+    return rate_limiter.client_ip(scope['client'][0] if scope.get('client') else None, forwarded_for)
+
+
+async def _send_rate_limited(send, result):
+    record_result(result)
+    await _send_json(send, result, 429, [(b'retry-after', retry_after_header(result).encode())])
+
+
+async def validate(scope, receive, send):
+    try:
+        data = await _read_json(receive)
+
+        if not data:
+            return await _send_json(send, {'valid': False, 'code': 'NO_DATA', 'message': 'No data provided'}, 400)
+
+        key_code = (data.get('key') or '').strip()
+        discord_id = data.get('discord_id')
+        hwid = (data.get('hwid') or '').strip()
+
+        if not key_code:
+            return await _send_json(send, {'valid': False, 'code': 'MISSING_KEY', 'message': 'Key is required'}, 400)
+
+        if rate_limiter is not None:
+            limited = rate_limiter.check(_client_ip(scope), key_code, hwid)
+            if limited:
+                log_validation(log, key_code, discord_id, limited)
+                return await _send_rate_limited(send, limited)
+
+        started = time.perf_counter()
+        try:
+            result = await key_system.validate_key(key_code, discord_id, hwid)
+        except Exception as e:
+            # Same shape validate_key_sync returns for database failures
+            result = {'valid': False, 'code': 'ERROR', 'message': str(e)}
+        elapsed = time.perf_counter() - started
+        record_result(result, elapsed)
+        log_validation(log, key_code, discord_id, result, elapsed)
+
+        notifier.submit(key_code, result['valid'], discord_id, None if result['valid'] else result['code'])
+        await _send_json(send, result, 503 if result['code'] == 'SERVICE_UNAVAILABLE' else 200)
+
+    except Exception as e:
+        await _send_json(send, {'valid': False, 'code': 'ERROR', 'message': str(e)}, 500)
+
+
+async def validate_batch(scope, receive, send):
+    try:
+        data = await _read_json(receive)
+        items = data.get('items') if isinstance(data, dict) else data
+
+        if not isinstance(items, list) or not items:
+            return await _send_json(send, {'code': 'INVALID_BATCH', 'message': 'Expected a non-empty array of {key, discord_id, hwid}'}, 400)
+        if len(items) > BATCH_MAX_ITEMS:
+            return await _send_json(send, {'code': 'BATCH_TOO_LARGE', 'message': f'At most {BATCH_MAX_ITEMS} items per request'}, 413)
+
+        if rate_limiter is not None:
+            limited = rate_limiter.check(_client_ip(scope), cost=len(items))
+            if limited:
+                return await _send_rate_limited(send, limited)
+            limited = rate_limiter.check_items(items)
+            allowed = [item for item, result in zip(items, limited) if result is None]
+            results = merge_batch_results(limited, await key_system.validate_keys_batch(allowed) if allowed else [])
+        else:
+            results = await key_system.validate_keys_batch(items)
+        for item, result in zip(items, results):
+            record_result(result)
+            if isinstance(item, dict):
+                log_validation(log, str(item.get('key') or '').strip(), item.get('discord_id'), result, batch=len(items))
+            if isinstance(item, dict) and item.get('key') and result['code'] != 'RATE_LIMITED':
+                notifier.submit(item['key'].strip(), result['valid'], item.get('discord_id'),
+                                None if result['valid'] else result['code'])
+        await _send_json(send, {'results': results})
+
+    except Exception as e:
+        await _send_json(send, {'code': 'ERROR', 'message': str(e)}, 500)
+
+
+async def health(scope, receive, send):
+    await _send_json(send, {
+        'status': 'ok',
+        'service': 'Terra Hub Key Validator',
+        'key_filter': key_system.key_filter.stats(),
+        'key_cache': key_system.key_cache.stats(),
+        'use_counter': key_system.use_counter.stats() if key_system.use_counter else None,
+        'db_breaker': key_system.breaker.stats(),
+        'db_replica': key_system.replica_stats(),
+        'notifier': notifier.stats(),
+        'rate_limiter': rate_limiter.stats() if rate_limiter else None,
+        'lookups': key_system.lookups.stats()
+    })
+
+
+async def metrics(scope, receive, send):
+    body = REGISTRY.render().encode()
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', CONTENT_TYPE.encode()), (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+register_validation_gauges(
+    **key_system.gauge_stats(),
+    notifier=notifier.stats,
+    rate_limiter=optional_stats(lambda: rate_limiter)
+)
+
+ROUTES = {
+    ('POST', '/validate'): validate,
+    ('POST', '/validate/batch'): validate_batch,
+    ('GET', '/health'): health,
+    ('GET', '/metrics'): metrics
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await key_system.init()
+                notifier.start()
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            log.info('Terra Hub Key Validation Server ready', extra={'fields': {'mode': 'async'}})
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await key_system.close()
+            await asyncio.to_thread(notifier.close)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    handler = ROUTES.get((scope['method'], scope['path']))
+    if handler is None:
+        if any(path == scope['path'] for _, path in ROUTES):
+            return await _send_json(send, {'code': 'METHOD_NOT_ALLOWED', 'message': 'Method not allowed'}, 405)
+        return await _send_json(send, {'code': 'NOT_FOUND', 'message': 'Not found'}, 404)
+    await handler(scope, receive, send)
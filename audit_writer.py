@@ -0,0 +1,355 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from structured_log import get_logger
+
+log = get_logger('audit_writer')
+
+AUDIT_COLUMNS = ('key_code', 'discord_id', 'hwid_hash', 'validated_at', 'success', 'error_code')
+
+BACKPRESSURE_POLICIES = ('block', 'drop_oldest', 'spill')
+
+
+def audit_record(key_code, discord_id, hwid_hash, success, error_code):
+    """Build a key_validations row stamped with the time of the validation, not the flush"""
+    return (key_code, discord_id, hwid_hash, datetime.now(), success, error_code)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def multirow_insert(records, placeholder='%s'):
+    """Build one INSERT ... VALUES (...), (...) statement for a batch of audit records"""
+    row = '(' + ', '.join([placeholder] * len(AUDIT_COLUMNS)) + ')'
+    sql = f"INSERT INTO key_validations ({', '.join(AUDIT_COLUMNS)}) VALUES " + ', '.join([row] * len(records))
+    params = [value for record in records for value in record]
+    return sql, params
+
+
+def audit_settings_from_env():
+    """Writer keyword arguments from the AUDIT_* environment variables"""
+    return {
+        'max_queue': int(os.environ.get('AUDIT_QUEUE_SIZE', 10000)),
+        'batch_size': int(os.environ.get('AUDIT_BATCH_SIZE', 500)),
+        'flush_interval': int(os.environ.get('AUDIT_FLUSH_MS', 250)) / 1000,
+        'policy': os.environ.get('AUDIT_BACKPRESSURE', 'drop_oldest'),
+        'spill_path': os.environ.get('AUDIT_SPILL_PATH') or None
+    }
+
+
+class _AuditQueue:
+    """Bounded buffer and backpressure bookkeeping shared by the sync and async writers.
+
+    Each process spills to ``spill_path`` suffixed with its pid, so
+    pre-forked workers sharing AUDIT_SPILL_PATH never replay or delete
+    each other's rows. On its first replay a writer also claims the files
+    of processes that have exited.
+    """
+
+    def __init__(self, max_queue=10000, batch_size=500, flush_interval=0.25,
+                 policy='drop_oldest', spill_path=None):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Unknown audit backpressure policy: {policy}")
+        if policy == 'spill' and not spill_path:
+            raise ValueError("The spill policy requires spill_path")
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.spill_path = spill_path
+        self._queue = deque()
+        self._spill_lock = threading.Lock()
+        self._orphans_replayed = False
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.failed_flushes = 0
+
+    def _offer(self, record):
+        """Enqueue without blocking; returns False only when the block policy must wait"""
+        if len(self._queue) < self.max_queue:
+            self._queue.append(record)
+            return True
+        if self.policy == 'drop_oldest':
+            self._queue.popleft()
+            self._queue.append(record)
+            self.dropped += 1
+            return True
+        if self.policy == 'spill':
+            self._spill([record])
+            return True
+        return False
+
+    def _take_batch(self):
+        batch = []
+        while self._queue and len(batch) < self.batch_size:
+            batch.append(self._queue.popleft())
+        return batch
+
+    def _requeue(self, batch):
+        """Put a failed batch back at the front, spilling or dropping what no longer fits"""
+        room = max(self.max_queue - len(self._queue), 0)
+        keep, overflow = batch[:room], batch[room:]
+        self._queue.extendleft(reversed(keep))
+        if overflow:
+            if self.spill_path:
+                self._spill(overflow)
+            else:
+                self.dropped += len(overflow)
+
+    def _spill_file(self):
+        return f'{self.spill_path}.{os.getpid()}'
+
+    def _orphaned_spill_files(self):
+        """Spill files of exited processes, plus an unsuffixed file from before per-process spilling"""
+        directory, prefix = os.path.split(os.path.abspath(self.spill_path))
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return []
+        paths = []
+        for name in names:
+            pid = name[len(prefix) + 1:] if name.startswith(prefix + '.') else ''
+            if name == prefix or (pid.isdigit() and not _process_alive(int(pid))):
+                paths.append(os.path.join(directory, name))
+        return paths
+
+    def _spill(self, records):
+        with self._spill_lock:
+            with open(self._spill_file(), 'a', encoding='utf-8') as f:
+                for record in records:
+                    row = list(record)
+                    row[3] = row[3].isoformat()
+                    f.write(json.dumps(row) + '\n')
+        self.spilled += len(records)
+
+    def _take_spilled(self):
+        """Read back and remove this process's spill file (and, the first time, orphaned ones)"""
+        if not self.spill_path:
+            return []
+        lines = []
+        with self._spill_lock:
+            own = self._spill_file()
+            paths = [own]
+            if not self._orphans_replayed:
+                self._orphans_replayed = True
+                paths += self._orphaned_spill_files()
+            for path in paths:
+                if path != own:
+                    # Renaming claims the file, so two starting workers never replay it twice
+                    claimed = f'{path}-replay-{os.getpid()}'
+                    try:
+                        os.rename(path, claimed)
+                    except OSError:
+                        continue
+                    path = claimed
+                elif not os.path.exists(path):
+                    continue
+                with open(path, encoding='utf-8') as f:
+                    lines.extend(f.readlines())
+                os.remove(path)
+        records = []
+        for line in lines:
+            try:
+                row = json.loads(line)
+                row[3] = datetime.fromisoformat(row[3])
+                records.append(tuple(row))
+            except (ValueError, IndexError):
+                continue
+        return records
+
+    def stats(self):
+        return {
+            'queued': len(self._queue),
+            'written': self.written,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'failed_flushes': self.failed_flushes
+        }
+
+
+class AuditWriter(_AuditQueue):
+    """Background thread that batches key_validations rows.
+
+    ``write_batch(records)`` is called from the writer thread with up to
+    ``batch_size`` records whenever the batch fills up or ``flush_interval``
+    seconds pass, whichever comes first.
+    """
+
+    def __init__(self, write_batch, block_timeout=1.0, **kwargs):
+        super().__init__(**kwargs)
+        self._write_batch = write_batch
+        self.block_timeout = block_timeout
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, record):
+        with self._cond:
+            deadline = time.monotonic() + self.block_timeout
+            while not self._offer(record):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.dropped += 1
+                    return
+                self._cond.wait(remaining)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+
+    def _flush_once(self):
+        with self._cond:
+            batch = self._take_batch()
+            self._cond.notify_all()
+        if not batch:
+            return False
+        try:
+            self._write_batch(batch)
+            self.written += len(batch)
+            return True
+        except Exception as e:
+            log.error('Audit flush failed', extra={'fields': {'error': str(e), 'rows': len(batch)}})
+            self.failed_flushes += 1
+            with self._cond:
+                self._requeue(batch)
+            return False
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._queue) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                stopping = self._stopping
+            flushed = self._flush_once()
+            if stopping and (not flushed or not self._queue):
+                return
+            if not flushed and self._queue:
+                time.sleep(self.flush_interval)  # back off while the database is failing
+            if not self._queue:
+                spilled = self._take_spilled()
+                if spilled:
+                    with self._cond:
+                        self._requeue(spilled)
+
+    def flush(self):
+        """Write everything queued right now from the calling thread"""
+        while self._queue:
+            if not self._flush_once():
+                break
+
+    def close(self, timeout=5.0):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._queue and self.spill_path:
+            with self._cond:
+                batch = list(self._queue)
+                self._queue.clear()
+            self._spill(batch)
+
+
+class AsyncAuditWriter(_AuditQueue):
+    """asyncio flavour of AuditWriter; ``write_batch`` is a coroutine function"""
+
+    def __init__(self, write_batch, block_timeout=1.0, **kwargs):
+        super().__init__(**kwargs)
+        self._write_batch = write_batch
+        self.block_timeout = block_timeout
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    async def submit(self, record):
+        deadline = time.monotonic() + self.block_timeout
+        while not self._offer(record):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.dropped += 1
+                return
+            self._space.clear()
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(self._space.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        if len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _flush_once(self):
+        batch = self._take_batch()
+        self._space.set()
+        if not batch:
+            return False
+        try:
+            await self._write_batch(batch)
+            self.written += len(batch)
+            return True
+        except Exception as e:
+            log.error('Audit flush failed', extra={'fields': {'error': str(e), 'rows': len(batch)}})
+            self.failed_flushes += 1
+            self._requeue(batch)
+            return False
+
+    async def _run(self):
+        while True:
+            if not self._stopping and len(self._queue) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            stopping = self._stopping
+            flushed = await self._flush_once()
+            if stopping and (not flushed or not self._queue):
+                return
+            if not flushed and self._queue:
+                await asyncio.sleep(self.flush_interval)
+            if not self._queue:
+                spilled = self._take_spilled()
+                if spilled:
+                    self._requeue(spilled)
+
+    async def flush(self):
+        while self._queue:
+            if not await self._flush_once():
+                break
+
+    async def close(self, timeout=5.0):
+        self._stopping = True
+        self._wakeup.set()
+        if self._task:
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                self._task.cancel()
+            self._task = None
+        if self._queue and self.spill_path:
+            batch = list(self._queue)
+            self._queue.clear()
+            self._spill(batch)
@@ -6,10 +6,14 @@ import random
 from datetime import datetime, timedelta
 from typing import Optional
 import time
-import secrets
-import json
-import hashlib
-from key_system import KeySystem
+import tempfile
+import signal
+from key_system import KeySystem, BATCH_MAX_ITEMS
+from token_store import token_store_from_env
+from signed_tokens import signer_from_env, is_signed_token
+from metrics import REGISTRY, optional_stats, record_result, register_validation_gauges
+from structured_log import get_logger, log_validation
+from rate_limit import limiter_from_env, merge_batch_results, retry_after_header
 from aiohttp import web
 
 intents = discord.Intents.default()
@@ -20,9 +24,27 @@ ALLOWED_USER_ID = 1242093054932811919
 bot_start_time = time.time()
 afk_users = {}
 active_games = {}
-validation_tokens = {}  # Store {token: {'user_id': ..., 'key': ..., 'timestamp': ...}}
-
-key_system = KeySystem()
+BULK_KEY_MAX = int(os.environ.get('BULK_KEY_MAX', 50000))
+validation_tokens = token_store_from_env()  # {token: {'user_id': ..., 'key': ..., 'timestamp': ...}}
+token_signer = signer_from_env()  # signed stateless tokens when TOKEN_SIGNING_KEYS is set
+# Trusts one proxy hop on Render; set RATE_LIMIT_PROXY_HOPS behind any other proxy, or every client shares one IP bucket
+rate_limiter = limiter_from_env()  # None when RATE_LIMIT=off
+
+# Signed-token revocations reach this process through key_system's key_events feed
+key_system = KeySystem(revoked=token_signer.revoked if token_signer else None)
+log = get_logger('bot')
+
+# Lifecycle of the pool and HTTP server, which outlive Discord gateway reconnects
+HTTP_PORT = int(os.environ.get('HTTP_PORT', 8080))
+HTTP_DRAIN_TIMEOUT = float(os.environ.get('HTTP_DRAIN_TIMEOUT', 10))
+services_started = False
+draining = False
+http_runner = None
+in_flight = 0
+
+def rate_limited_response(result):
+    record_result(result)
+    return web.json_response(result, status=429, headers={'Retry-After': retry_after_header(result)})
 
 async def validation_handler(request):
     try:
@@ -34,19 +56,183 @@ async def validation_handler(request):
         if not key_code:
             return web.json_response({'valid': False, 'code': 'MISSING_KEY', 'message': 'Key is required'}, status=400)
         
+        if rate_limiter is not None:
+            ip = rate_limiter.client_ip(request.remote, request.headers.get('X-Forwarded-For'))
+            limited = rate_limiter.check(ip, str(key_code).strip(), str(hwid or '').strip())
+            if limited:
+                log_validation(log, key_code, discord_id, limited)
+                return rate_limited_response(limited)
+        
+        started = time.perf_counter()
         result = await key_system.validate_key(key_code, discord_id, hwid)
-        return web.json_response(result)
+        elapsed = time.perf_counter() - started
+        record_result(result, elapsed)
+        log_validation(log, key_code, discord_id, result, elapsed)
+        return web.json_response(result, status=503 if result['code'] == 'SERVICE_UNAVAILABLE' else 200)
+    except Exception as e:
+        return web.json_response({'valid': False, 'code': 'ERROR', 'message': str(e)}, status=500)
+
+async def batch_validation_handler(request):
+    try:
+        data = await request.json()
+        items = data.get('items') if isinstance(data, dict) else data
+        
+        if not isinstance(items, list) or not items:
+            return web.json_response({'code': 'INVALID_BATCH', 'message': 'Expected a non-empty array of {key, discord_id, hwid}'}, status=400)
+        if len(items) > BATCH_MAX_ITEMS:
+            return web.json_response({'code': 'BATCH_TOO_LARGE', 'message': f'At most {BATCH_MAX_ITEMS} items per request'}, status=413)
+        
+        if rate_limiter is not None:
+            ip = rate_limiter.client_ip(request.remote, request.headers.get('X-Forwarded-For'))
+            limited = rate_limiter.check(ip, cost=len(items))
+            if limited:
+                return rate_limited_response(limited)
+            limited = rate_limiter.check_items(items)
+            allowed = [item for item, result in zip(items, limited) if result is None]
+            results = merge_batch_results(limited, await key_system.validate_keys_batch(allowed) if allowed else [])
+        else:
+            results = await key_system.validate_keys_batch(items)
+        for item, result in zip(items, results):
+            record_result(result)
+            if isinstance(item, dict):
+                log_validation(log, str(item.get('key') or '').strip(), item.get('discord_id'), result, batch=len(items))
+        return web.json_response({'results': results})
+    except Exception as e:
+        return web.json_response({'code': 'ERROR', 'message': str(e)}, status=500)
+
+async def revoke_signed_token(claims):
+    """Revoke a signed token everywhere; False if it was already revoked"""
+    revoked = await key_system.revoke_token(claims['jti'], claims['exp'])
+    token_signer.revoked.add(claims['jti'], claims['exp'])
+    return revoked
+
+async def verify_executor_token(token, hwid=None, consume=False):
+    """Look up an executor token of either kind; returns ({'user_id', 'age'}, None) or (None, error_code)"""
+    token = token.strip()
+    if token_signer and is_signed_token(token):
+        claims, error = token_signer.verify(token, key_system.hash_hwid(hwid))
+        if error:
+            return None, error
+        if consume and not await revoke_signed_token(claims):
+            return None, 'TOKEN_REVOKED'
+        # While the feed is down a revocation may not have reached token_signer.revoked yet
+        if not consume and not key_system.feed_healthy() and await key_system.token_revoked(claims['jti']):
+            return None, 'TOKEN_REVOKED'
+        return {'user_id': claims['u'], 'age': int(time.time() - claims['iat'])}, None
+    
+    token = token.upper()
+    token_data = await validation_tokens.consume(token) if consume else validation_tokens.get(token)
+    if not token_data:
+        return None, 'TOKEN_INVALID'
+    return {'user_id': token_data['user_id'], 'age': int(time.time() - token_data['timestamp'])}, None
+
+async def token_verify_handler(request):
+    try:
+        if request.method == 'POST' and request.can_read_body:
+            data = await request.json()
+        else:
+            data = request.query
+        token = str(data.get('token') or '').strip()
+        consume = str(data.get('consume', '')).lower() in ('1', 'true', 'yes')
+        
+        if not token:
+            return web.json_response({'valid': False, 'code': 'MISSING_TOKEN', 'message': 'Token is required'}, status=400)
+        
+        token_data, error = await verify_executor_token(token, data.get('hwid'), consume)
+        if error:
+            return web.json_response({'valid': False, 'code': error, 'message': 'Token not found, invalid or expired'})
+        
+        return web.json_response({
+            'valid': True,
+            'code': 'TOKEN_VALID',
+            'message': 'Token consumed' if consume else 'Token is valid',
+            'user_id': token_data['user_id'],
+            'age': token_data['age']
+        })
     except Exception as e:
         return web.json_response({'valid': False, 'code': 'ERROR', 'message': str(e)}, status=500)
 
+async def metrics_handler(request):
+    return web.Response(text=REGISTRY.render(), content_type='text/plain')
+
+register_validation_gauges(
+    **key_system.gauge_stats(),
+    validation_tokens=validation_tokens.stats,
+    rate_limiter=optional_stats(lambda: rate_limiter)
+)
+
+async def health_handler(request):
+    """Liveness: the process is up, whatever the state of Discord or the database"""
+    return web.json_response({
+        'status': 'ok',
+        'discord_connected': bot.is_ready(),
+        'uptime': int(time.time() - bot_start_time),
+        'in_flight': in_flight
+    })
+
+async def ready_handler(request):
+    """Readiness: validations can be served (pool up, breaker not open, not shutting down)"""
+    breaker = key_system.breaker.state
+    ready = services_started and not draining and breaker != 'open'
+    return web.json_response({'ready': ready, 'draining': draining, 'db_breaker': breaker},
+                             status=200 if ready else 503)
+
+@web.middleware
+async def track_in_flight(request, handler):
+    global in_flight
+    in_flight += 1
+    try:
+        return await handler(request)
+    finally:
+        in_flight -= 1
+
 async def start_http_server():
-    app = web.Application()
+    global http_runner
+    if http_runner is not None:
+        return
+    app = web.Application(middlewares=[track_in_flight])
     app.router.add_post('/validate', validation_handler)
+    app.router.add_post('/validate/batch', batch_validation_handler)
+    app.router.add_get('/token/verify', token_verify_handler)
+    app.router.add_post('/token/verify', token_verify_handler)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/health', health_handler)
+    app.router.add_get('/ready', ready_handler)
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', 8080)
+    site = web.TCPSite(runner, '0.0.0.0', HTTP_PORT)
     await site.start()
-    print('HTTP validation server started on http://0.0.0.0:8080')
+    http_runner = runner
+    log.info('HTTP validation server started', extra={'fields': {'url': f'http://0.0.0.0:{HTTP_PORT}'}})
+
+async def start_services():
+    """Open the database pool, load token state and start the HTTP server, once"""
+    global services_started
+    if services_started:
+        return
+    await key_system.init()
+    if os.environ.get('TOKEN_STORE_PERSIST'):
+        # Through the circuit breaker and acquire timeout, like every other query
+        await validation_tokens.attach(key_system.connection)
+    validation_tokens.start(float(os.environ.get('TOKEN_SWEEP_INTERVAL', 60)))
+    await start_http_server()
+    services_started = True
+
+async def stop_services():
+    """Fail /ready, let in-flight requests finish, then close the HTTP server and the pool"""
+    global draining, services_started, http_runner
+    draining = True
+    deadline = time.monotonic() + HTTP_DRAIN_TIMEOUT
+    while in_flight and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    if in_flight:
+        log.warning('Shutting down with requests still in flight', extra={'fields': {'in_flight': in_flight}})
+    if http_runner is not None:
+        await http_runner.cleanup()
+        http_runner = None
+    validation_tokens.close()
+    await key_system.close()
+    services_started = False
 
 @bot.check
 async def globally_block_users(ctx):
@@ -936,6 +1122,90 @@ async def emojify(ctx, *, text: str):
     
     await ctx.send(result)
 
+class PageView(discord.ui.View):
+    """Previous/Next buttons over a keyset-paginated KeySystem listing.
+
+    Only the cursors of visited pages are kept, so going back re-runs the
+    same indexed query instead of holding earlier pages in memory.
+    """
+    
+    def __init__(self, author_id, fetch, render, first_page):
+        super().__init__(timeout=180)
+        self.author_id = author_id
+        self.fetch = fetch
+        self.render = render
+        self.cursors = [None]
+        self.page = first_page
+        self.message = None
+        self._sync_buttons()
+    
+    def embed(self):
+        return self.render(self.page, len(self.cursors))
+    
+    def _sync_buttons(self):
+        self.previous_page.disabled = len(self.cursors) == 1
+        self.next_page.disabled = self.page['next'] is None
+    
+    async def _show(self, interaction):
+        self.page = await self.fetch(self.cursors[-1])
+        self._sync_buttons()
+        await interaction.response.edit_message(embed=self.embed(), view=self)
+    
+    async def interaction_check(self, interaction):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message('❌ Only the person who ran the command can change pages.', ephemeral=True)
+            return False
+        return True
+    
+    @discord.ui.button(label='◀ Previous', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        self.cursors.pop()
+        await self._show(interaction)
+    
+    @discord.ui.button(label='Next ▶', style=discord.ButtonStyle.primary)
+    async def next_page(self, interaction, button):
+        self.cursors.append(self.page['next'])
+        await self._show(interaction)
+    
+    async def on_timeout(self):
+        for item in self.children:
+            item.disabled = True
+        if self.message:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
+
+async def send_paged(ctx, fetch, render, empty_message):
+    page = await fetch(None)
+    
+    if not page['items']:
+        await ctx.send(empty_message)
+        return
+    
+    if page['next'] is None:
+        await ctx.send(embed=render(page, 1))
+        return
+    
+    view = PageView(ctx.author.id, fetch, render, page)
+    view.message = await ctx.send(embed=view.embed(), view=view)
+
+def scripts_embed(page, number):
+    embed = discord.Embed(
+        title='📜 All Scripts',
+        color=discord.Color.blue()
+    )
+    
+    for script in page['items']:
+        embed.add_field(
+            name=script['script_name'],
+            value=f'ID: `{script["script_id"]}`\n{script.get("description", "No description")}',
+            inline=False
+        )
+    
+    embed.set_footer(text=f'Page {number}')
+    return embed
+
 @bot.command(name='script')
 async def manage_script(ctx, action: str = None, *, args: str = ''):
     if action == 'add':
@@ -959,25 +1229,12 @@ async def manage_script(ctx, action: str = None, *, args: str = ''):
             await ctx.send(f'❌ Error: {result["error"]}')
     
     elif action == 'list':
-        scripts = await key_system.get_all_scripts()
-        
-        if not scripts:
-            await ctx.send('No scripts found.')
-            return
-        
-        embed = discord.Embed(
-            title='📜 All Scripts',
-            color=discord.Color.blue()
+        await send_paged(
+            ctx,
+            lambda after: key_system.get_scripts_page(after, limit=10),
+            scripts_embed,
+            'No scripts found.'
         )
-        
-        for script in scripts[:10]:
-            embed.add_field(
-                name=script['script_name'],
-                value=f'ID: `{script["script_id"]}`\n{script.get("description", "No description")}',
-                inline=False
-            )
-        
-        await ctx.send(embed=embed)
     
     else:
         await ctx.send('Usage: `?script add [name] | [description]` or `?script list`')
@@ -1008,6 +1265,49 @@ async def generate_key(ctx, script_id: str, days: int = 0, max_uses: int = -1, *
     else:
         await ctx.send(f'❌ Error: {result["error"]}')
 
+@bot.command(name='genkeys')
+async def generate_keys_bulk(ctx, script_id: str, count: int, days: int = 0, max_uses: int = -1, file_format: str = 'txt'):
+    file_format = file_format.lower()
+    if file_format not in ('txt', 'csv'):
+        await ctx.send('❌ Format must be `txt` or `csv`')
+        return
+    if count < 1 or count > BULK_KEY_MAX:
+        await ctx.send(f'❌ Count must be between 1 and {BULK_KEY_MAX}')
+        return
+    
+    status = await ctx.send(f'⏳ Generating {count} keys...')
+    expires_at = datetime.now() + timedelta(days=days) if days > 0 else None
+    
+    # Keys are written out chunk by chunk; the spooled file moves to disk once it grows
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as out:
+        if file_format == 'csv':
+            out.write(b'key,script_id,expires_at,max_uses\n')
+        expires = expires_at.strftime('%Y-%m-%d %H:%M:%S') if expires_at else ''
+        
+        created = 0
+        try:
+            async for chunk in key_system.create_keys_bulk(script_id, count, days if days > 0 else None, max_uses):
+                if file_format == 'csv':
+                    lines = [f'{key_code},{script_id},{expires},{max_uses}\n' for key_code in chunk]
+                else:
+                    lines = [f'{key_code}\n' for key_code in chunk]
+                out.write(''.join(lines).encode())
+                created += len(chunk)
+        except ValueError as e:
+            await status.edit(content=f'❌ Error: {e}')
+            return
+        except Exception as e:
+            await status.edit(content=f'❌ Error after {created} keys: {e}')
+            if not created:
+                return
+        
+        out.seek(0)
+        filename = f'keys_{script_id[:8]}_{created}.{file_format}'
+        await ctx.send(f'🔑 Generated {created} keys for `{script_id}`', file=discord.File(out, filename=filename))
+    
+    if created == count:
+        await status.delete()
+
 @bot.command(name='redeemkey')
 async def redeem_key_command(ctx, key_code: str):
     result = await key_system.redeem_key(key_code, ctx.author.id)
@@ -1064,20 +1364,13 @@ async def check_key(ctx, key_code: str):
     
     await ctx.send(embed=embed)
 
-@bot.command(name='mykeys')
-async def my_keys(ctx):
-    keys = await key_system.get_user_keys(ctx.author.id)
-    
-    if not keys:
-        await ctx.send('You don\'t have any keys.')
-        return
-    
+def my_keys_embed(page, number):
     embed = discord.Embed(
         title='🔑 Your Keys',
         color=discord.Color.purple()
     )
     
-    for key in keys[:10]:
+    for key in page['items']:
         status = '✅' if key['is_active'] else '❌'
         expires = key['expires_at'].strftime('%Y-%m-%d') if key['expires_at'] else 'Never'
         uses = f"{key['current_uses']}/{key['max_uses']}" if key['max_uses'] > 0 else f"{key['current_uses']}/∞"
@@ -1088,26 +1381,16 @@ async def my_keys(ctx):
             inline=False
         )
     
-    if len(keys) > 10:
-        embed.set_footer(text=f'Showing 10 of {len(keys)} keys')
-    
-    await ctx.send(embed=embed)
+    embed.set_footer(text=f'Page {number}')
+    return embed
 
-@bot.command(name='allkeys')
-async def all_keys(ctx):
-    keys = await key_system.get_all_keys()
-    
-    if not keys:
-        await ctx.send('No keys found in the system.')
-        return
-    
+def all_keys_embed(page, number):
     embed = discord.Embed(
         title='🔑 All Keys',
-        description=f'Total: {len(keys)} keys',
         color=discord.Color.blue()
     )
     
-    for key in keys[:15]:
+    for key in page['items']:
         status = '✅' if key['is_active'] else '❌'
         expires = key['expires_at'].strftime('%Y-%m-%d') if key['expires_at'] else 'Never'
         uses = f"{key['current_uses']}/{key['max_uses']}" if key['max_uses'] > 0 else f"{key['current_uses']}/∞"
@@ -1119,10 +1402,26 @@ async def all_keys(ctx):
             inline=False
         )
     
-    if len(keys) > 15:
-        embed.set_footer(text=f'Showing 15 of {len(keys)} keys')
-    
-    await ctx.send(embed=embed)
+    embed.set_footer(text=f'Page {number}')
+    return embed
+
+@bot.command(name='mykeys')
+async def my_keys(ctx):
+    await send_paged(
+        ctx,
+        lambda after: key_system.get_keys_page(ctx.author.id, after, limit=10),
+        my_keys_embed,
+        'You don\'t have any keys.'
+    )
+
+@bot.command(name='allkeys')
+async def all_keys(ctx):
+    await send_paged(
+        ctx,
+        lambda after: key_system.get_keys_page(None, after, limit=15),
+        all_keys_embed,
+        'No keys found in the system.'
+    )
 
 @bot.command(name='deletekey')
 async def delete_key_command(ctx, key_code: str):
@@ -1145,17 +1444,15 @@ async def reset_hwid_command(ctx, key_code: str):
 @bot.command(name='validate')
 async def validate_key_command(ctx, key_code: str):
     result = await key_system.validate_key(key_code)
+    record_result(result)
     
     if result['valid']:
-        # Generate validation token (32 hex chars = 16 bytes)
-        validation_token = secrets.token_hex(16).upper()
-        
-        # Store token with metadata
-        validation_tokens[validation_token] = {
-            'user_id': ctx.author.id,
-            'key': key_code[:8],
-            'timestamp': time.time()
-        }
+        if token_signer:
+            # Self-contained: any validator holding the signing keys can verify it
+            validation_token = token_signer.sign(ctx.author.id, key_code, ttl=validation_tokens.ttl)
+        else:
+            # Generate validation token (32 hex chars = 16 bytes) and store it with metadata
+            validation_token = await validation_tokens.issue(ctx.author.id, key_code)
         
         embed = discord.Embed(
             title='✅ Key Validation Successful',
@@ -1197,19 +1494,32 @@ async def validate_key_command(ctx, key_code: str):
 @bot.command(name='checktoken')
 async def check_token_command(ctx, token: str):
     """Check if a validation token is still valid"""
-    token = token.upper().strip()
-    
-    if token in validation_tokens:
-        token_data = validation_tokens[token]
-        age = time.time() - token_data['timestamp']
-        
-        if age < 1800:  # 30 minutes
-            await ctx.send(f'✅ Token is VALID (Age: {int(age)}s)')
+    token_data, error = await verify_executor_token(token)
+    
+    if token_data:
+        await ctx.send(f'✅ Token is VALID (Age: {token_data["age"]}s)')
+    elif token_signer and is_signed_token(token.strip()) and error == 'TOKEN_EXPIRED':
+        # Only signed tokens can report expiry; an expired stored token is simply gone
+        await ctx.send(f'⏰ Token EXPIRED')
+    elif error == 'TOKEN_REVOKED':
+        await ctx.send(f'🚫 Token REVOKED')
+    else:
+        await ctx.send(f'❌ Token not found, invalid or expired')
+
+@bot.command(name='revoketoken')
+async def revoke_token_command(ctx, token: str):
+    """Invalidate an executor token before it expires"""
+    token = token.strip()
+    if token_signer and is_signed_token(token):
+        claims, error = token_signer.verify(token)
+        if claims and await revoke_signed_token(claims):
+            await ctx.send('🚫 Token revoked on every validator')
         else:
-            await ctx.send(f'⏰ Token EXPIRED')
-            del validation_tokens[token]
+            await ctx.send(f'❌ Token could not be revoked ({error or "TOKEN_REVOKED"})')
+    elif await validation_tokens.consume(token.upper()):
+        await ctx.send('🚫 Token revoked')
     else:
-        await ctx.send(f'❌ Token not found or invalid')
+        await ctx.send('❌ Token not found, invalid or expired')
 
 @bot.event
 async def on_message(message):
@@ -1322,12 +1632,14 @@ async def help_command(ctx):
               '`?script add [name] | [desc]` - Add script\n'
               '`?script list` - List all scripts\n'
               '`?genkey [script_id] [days] [max_uses] [note]`\n'
+              '`?genkeys [script_id] [count] [days] [max_uses] [txt|csv]` - Bulk keys as a file\n'
               '`?allkeys` - View all keys\n'
               '`?deletekey [key]` - Delete key\n'
               '`?resethwid [key]` - Reset HWID\n\n'
               '**User:**\n'
               '`?redeemkey [key]` - Redeem key\n'
               '`?checkkey [key]` - Check key info\n'
+              '`?checktoken [token]` / `?revoketoken [token]` - Executor tokens\n'
               '`?mykeys` - View your keys',
         inline=False
     )
@@ -1337,9 +1649,8 @@ async def help_command(ctx):
 
 @bot.event
 async def on_ready():
-    await key_system.init()
-    asyncio.create_task(start_http_server())
-    print(f'{bot.user} has connected to Discord!')
+    # Fires again after every gateway reconnect; the pool and HTTP server were started once in main()
+    log.info('Connected to Discord', extra={'fields': {'user': str(bot.user)}})
 
 async def main():
     bot_token = os.getenv('DISCORD_BOT_TOKEN')
@@ -1347,9 +1658,19 @@ async def main():
         raise ValueError("DISCORD_BOT_TOKEN not found in environment variables. Please add it in the Secrets tab.")
     
     try:
+        # SIGTERM (e.g. a deploy) closes the gateway, then the finally block drains
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+    except NotImplementedError:
+        pass
+    
+    try:
+        # Validation is served before and regardless of the Discord connection
+        await start_services()
         await bot.start(bot_token)
     finally:
-        await key_system.close()
+        if not bot.is_closed():
+            await bot.close()
+        await stop_services()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+
+
+class CircuitBreaker:
+    """Fail fast while the database is saturated instead of queueing on it.
+
+    After ``failure_threshold`` consecutive failures (timeouts, refused
+    connections) the breaker opens and ``allow()`` returns False for
+    ``reset_timeout`` seconds. Then a single trial call is let through
+    (half-open): success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_at = None
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            now = time.monotonic()
+            # A trial that never reported back (cancelled) stops blocking after reset_timeout
+            if state == 'half_open' and (self._trial_at is None or now - self._trial_at >= self.reset_timeout):
+                self._trial_at = now
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    self.trips += 1
+                self._opened_at = time.monotonic()
+                self._trial_at = None
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self._failures,
+            'trips': self.trips,
+            'rejected': self.rejected
+        }
+
+
+def breaker_from_env():
+    return CircuitBreaker(
+        failure_threshold=int(os.environ.get('DB_BREAKER_THRESHOLD', 5)),
+        reset_timeout=float(os.environ.get('DB_BREAKER_RESET', 10))
+    )
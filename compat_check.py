@@ -0,0 +1,82 @@
+"""Send identical requests to two validator deployments and diff the responses.
+
+    python compat_check.py http://localhost:5000 http://localhost:8000 --key <KEY> [--hwid <HWID>]
+
+Intended for comparing app.py (Flask) against asgi_app.py (async mode)
+pointed at the same database. Requests that change state (a valid key
+being counted, an HWID being bound) are sent to both servers in turn, so
+use keys with unlimited uses.
+"""
+import argparse
+import sys
+
+import requests
+
+
+def build_cases(key, hwid):
+    cases = [
+        ('health', 'GET', '/health', None),
+        ('no body', 'POST', '/validate', {}),
+        ('missing key', 'POST', '/validate', {'key': ''}),
+        ('unknown key', 'POST', '/validate', {'key': 'DOES-NOT-EXIST-0000'}),
+        ('non-numeric discord id', 'POST', '/validate', {'key': key or 'X', 'discord_id': 'abc'}),
+    ]
+    if key:
+        cases.append(('valid key', 'POST', '/validate', {'key': key}))
+        if hwid:
+            cases.append(('valid key with hwid', 'POST', '/validate', {'key': key, 'hwid': hwid}))
+            cases.append(('hwid mismatch', 'POST', '/validate', {'key': key, 'hwid': hwid + '-other'}))
+    return cases
+
+
+def fetch(base_url, method, path, body):
+    response = requests.request(method, base_url.rstrip('/') + path, json=body, timeout=10)
+    try:
+        payload = response.json()
+    except ValueError:
+        payload = response.text
+    return response.status_code, payload
+
+
+# Fields that change between the two sequential requests even when the servers agree
+VOLATILE_FIELDS = ('retry_after',)
+VOLATILE_DATA_FIELDS = ('current_uses',)
+
+
+def comparable(path, payload):
+    """Fields that are part of the contract; /health stats and per-request counters legitimately differ"""
+    if not isinstance(payload, dict):
+        return payload
+    if path == '/health':
+        return {k: payload.get(k) for k in ('status', 'service')}
+    payload = {k: v for k, v in payload.items() if k not in VOLATILE_FIELDS}
+    if isinstance(payload.get('data'), dict):
+        payload['data'] = {k: v for k, v in payload['data'].items() if k not in VOLATILE_DATA_FIELDS}
+    return payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('first')
+    parser.add_argument('second')
+    parser.add_argument('--key', help='An existing key with unlimited uses')
+    parser.add_argument('--hwid', help='HWID to bind during the run')
+    args = parser.parse_args()
+
+    failures = 0
+    for name, method, path, body in build_cases(args.key, args.hwid):
+        first = fetch(args.first, method, path, body)
+        second = fetch(args.second, method, path, body)
+        first = (first[0], comparable(path, first[1]))
+        second = (second[0], comparable(path, second[1]))
+        if first == second:
+            print(f"✅ {name}: {first[0]} {first[1]}")
+        else:
+            failures += 1
+            print(f"❌ {name}:\n   {args.first}: {first}\n   {args.second}: {second}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# The parts of a key that only change through explicit admin/bind operations
+CACHED_FIELDS = ('script_name', 'expires_at', 'discord_id', 'hwid_hash', 'max_uses', 'is_active')
+
+# Set-based lookup of many keys' cacheable fields in one round trip
+PREFETCH_SQL = '''
+    SELECT k.key_code, s.script_name, k.expires_at, k.discord_id, k.hwid_hash, k.max_uses, k.is_active
+    FROM keys k
+    JOIN scripts s ON k.script_id = s.script_id
+    WHERE k.key_code = ANY({0})
+'''
+
+
+def prefetch_sql(style='format'):
+    return PREFETCH_SQL.format('$1::varchar[]' if style == 'numeric' else '%s')
+
+
+def check_cached_key(record, discord_id, hwid_hash, now):
+    """Return the failure code a cached record already guarantees, or None.
+
+    Mirrors the order of checks in validate_key_atomic. max_uses is left to
+    the database because current_uses is not cached.
+    """
+    if not record['is_active']:
+        return 'KEY_INACTIVE'
+    if record['expires_at'] and now > record['expires_at']:
+        return 'KEY_EXPIRED'
+    if discord_id and record['discord_id'] and record['discord_id'] != discord_id:
+        return 'DISCORD_ID_MISMATCH'
+    if hwid_hash and record['hwid_hash'] and record['hwid_hash'] != hwid_hash:
+        return 'HWID_MISMATCH'
+    return None
+
+
+class KeyCache:
+    """Thread-safe LRU cache of key metadata with a TTL.
+
+    Callers take ``epoch()`` before reading from the database and pass it to
+    ``put``; if any invalidation happened in between the stale read is not
+    cached.
+    """
+
+    def __init__(self, max_size=10000, ttl=60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def epoch(self):
+        return self._epoch
+
+    def get(self, key_code):
+        with self._lock:
+            entry = self._entries.get(key_code)
+            if entry is None:
+                self.misses += 1
+                return None
+            record, expires = entry
+            if time.monotonic() > expires:
+                del self._entries[key_code]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key_code)
+            self.hits += 1
+            return record
+
+    def put(self, key_code, record, epoch):
+        record = {field: record[field] for field in CACHED_FIELDS}
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            self._entries[key_code] = (record, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key_code)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key_code):
+        with self._lock:
+            self._epoch += 1
+            self._entries.pop(key_code, None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+def cache_from_env():
+    return KeyCache(
+        max_size=int(os.environ.get('KEY_CACHE_SIZE', 10000)),
+        ttl=float(os.environ.get('KEY_CACHE_TTL', 60))
+    )
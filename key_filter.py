@@ -0,0 +1,170 @@
+import hashlib
+import math
+import threading
+import time
+
+
+class CountingBloomFilter:
+    """Bloom filter with 8-bit counters so deleted keys can be removed again.
+
+    ``remove`` must only be called for items that were added, otherwise it
+    can introduce false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(int(capacity), 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hash_count = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.counters = bytearray(self.size)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        counters = self.counters
+        for pos in self._positions(item):
+            if counters[pos] < 255:
+                counters[pos] += 1
+        self.count += 1
+
+    def remove(self, item):
+        counters = self.counters
+        positions = self._positions(item)
+        if not all(counters[pos] for pos in positions):
+            return
+        for pos in positions:
+            if counters[pos] < 255:  # saturated counters no longer know their true count
+                counters[pos] -= 1
+        self.count = max(self.count - 1, 0)
+
+    def __contains__(self, item):
+        counters = self.counters
+        return all(counters[pos] for pos in self._positions(item))
+
+    def estimated_false_positive_rate(self):
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+
+class KeyFilter:
+    """Thread-safe set-membership guard for keys.key_code.
+
+    ``might_contain`` returning False means the key definitely does not
+    exist. Until the first rebuild, or once the feed of key changes has gone
+    quiet for longer than ``stale_after`` seconds, every key is reported as
+    possibly present so lookups fall through to the database.
+    """
+
+    def __init__(self, error_rate=0.001, min_capacity=10000, stale_after=None):
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.stale_after = stale_after
+        self._lock = threading.Lock()
+        self._filter = None
+        self._pending = None
+        self._heartbeat = None
+        self.rebuild_seconds = None
+        self.rebuilt_at = None
+        self.rejected = 0
+        self.false_positives = 0
+
+    @property
+    def ready(self):
+        if self._filter is None:
+            return False
+        if self.stale_after is not None:
+            return self._heartbeat is not None and time.monotonic() - self._heartbeat <= self.stale_after
+        return True
+
+    def touch(self):
+        """Record that the change feed is alive, keeping the filter authoritative"""
+        self._heartbeat = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._filter = None
+
+    def begin_rebuild(self):
+        """Start recording adds so keys created while the table is scanned are not lost"""
+        with self._lock:
+            self._pending = []
+        return time.perf_counter()
+
+    def finish_rebuild(self, key_codes, started=None):
+        key_codes = list(key_codes)
+        bloom = CountingBloomFilter(max(len(key_codes) * 2, self.min_capacity), self.error_rate)
+        for key_code in key_codes:
+            bloom.add(key_code)
+        with self._lock:
+            for key_code in self._pending or ():
+                bloom.add(key_code)
+            self._filter = bloom
+            self._pending = None
+        if started is not None:
+            self.rebuild_seconds = time.perf_counter() - started
+        self.rebuilt_at = time.time()
+        self.touch()
+
+    def add(self, key_code):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(key_code)
+            if self._filter is not None:
+                self._filter.add(key_code)
+
+    def remove(self, key_code):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.remove(key_code)
+
+    def might_contain(self, key_code):
+        if not self.ready:
+            return True
+        if key_code in self._filter:
+            return True
+        self.rejected += 1
+        return False
+
+    def record_false_positive(self):
+        self.false_positives += 1
+
+    def needs_rebuild(self):
+        bloom = self._filter
+        return bloom is not None and bloom.count > bloom.capacity
+
+    def stats(self):
+        bloom = self._filter
+        checked = self.rejected + self.false_positives
+        return {
+            'ready': self.ready,
+            'keys': bloom.count if bloom else 0,
+            'capacity': bloom.capacity if bloom else 0,
+            'estimated_false_positive_rate': bloom.estimated_false_positive_rate() if bloom else None,
+            'observed_false_positive_rate': self.false_positives / checked if checked else None,
+            'rejected': self.rejected,
+            'false_positives': self.false_positives,
+            'rebuild_seconds': self.rebuild_seconds,
+            'rebuilt_at': self.rebuilt_at
+        }
+
+
+def apply_key_event(payload, key_filter, key_cache, use_counter=None, revoked=None):
+    """Apply one LISTEN key_events payload ('OP:key_code' or 'REVOKE:jti:expires') to local state"""
+    op, _, key_code = payload.partition(':')
+    if op == 'INSERT':
+        key_filter.add(key_code)
+    elif op == 'DELETE':
+        key_filter.remove(key_code)
+        key_cache.invalidate(key_code)
+        if use_counter is not None:
+            use_counter.forget(key_code)
+    elif op == 'UPDATE':
+        key_cache.invalidate(key_code)
+    elif op == 'REVOKE' and revoked is not None:
+        jti, _, expires = key_code.partition(':')
+        revoked.add(jti, int(expires))
@@ -1,83 +1,335 @@
 import os
+import asyncio
 import asyncpg
+import contextlib
 from datetime import datetime, timedelta
 import secrets
-import hashlib
+import time
+from audit_writer import AsyncAuditWriter, AUDIT_COLUMNS, audit_settings_from_env
+from key_filter import KeyFilter, apply_key_event
+from key_cache import cache_from_env, prefetch_sql
+from use_counter import counter_from_env, reserve_sql, flush_sql
+from migrations import prepare_database, maintain_partitions
+from circuit_breaker import breaker_from_env
+from single_flight import AsyncSingleFlight
+from signed_tokens import load_revoked_sql, revoke_sql
+from validation import LOOKUP, JOIN, RESERVE, PREFETCH, AUDIT, ValidationEngine, failure, hash_hwid, run_async
+from metrics import PHASE_SECONDS, optional_stats
+from structured_log import get_logger
+
+log = get_logger('key_system')
+
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 100))
+KEY_EVENTS_POLL_INTERVAL = float(os.environ.get('KEY_EVENTS_POLL_INTERVAL', 0.5))
+KEY_FILTER_REBUILD_INTERVAL = float(os.environ.get('KEY_FILTER_REBUILD_INTERVAL', 3600))
+
+# Hot-path statements, prepared on every pool connection: name -> (sql, timeout seconds)
+STATEMENT_TIMEOUT = float(os.environ.get('DB_STATEMENT_TIMEOUT', 2))
+STATEMENTS = {
+    'validate': ('SELECT * FROM validate_key_atomic($1, $2, $3, $4, $5)', STATEMENT_TIMEOUT),
+    'prefetch': (prefetch_sql('numeric'), STATEMENT_TIMEOUT),
+    'reserve': (reserve_sql('numeric'), STATEMENT_TIMEOUT)
+}
+
+# Latency phase each statement is reported under in /metrics
+STATEMENT_PHASES = {'validate': 'lookup', 'prefetch': 'lookup', 'reserve': 'update'}
+
+# Errors meaning Postgres is unreachable or saturated, as opposed to a bad query
+SATURATION_ERRORS = (
+    asyncio.TimeoutError,
+    OSError,
+    asyncpg.TooManyConnectionsError,
+    asyncpg.CannotConnectNowError,
+    asyncpg.ConnectionDoesNotExistError,
+    asyncpg.QueryCanceledError
+)
+
+# How far behind the primary a read replica is, in seconds (0 once it has replayed all it received)
+REPLICA_LAG_SQL = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END::float8
+'''
+
+class DatabaseUnavailable(Exception):
+    """Raised instead of waiting when the database circuit breaker is open"""
+
+class StatementConnection(asyncpg.Connection):
+    """Pool connection carrying its prepared STATEMENTS"""
+    
+    async def prepare_registry(self):
+        self.statements = {name: await self.prepare(sql) for name, (sql, _) in STATEMENTS.items()}
+
+def _page(rows, limit):
+    """Split a LIMIT limit + 1 result into a page and the cursor for the next one"""
+    items = [dict(row) for row in rows[:limit]]
+    next_cursor = (items[-1]['created_at'], items[-1]['id']) if len(rows) > limit else None
+    return {'items': items, 'next': next_cursor}
 
 class KeySystem:
-    def __init__(self):
+    def __init__(self, listen=None, revoked=None):
         self.db_url = os.environ.get('DATABASE_URL')
         if not self.db_url:
             raise ValueError("DATABASE_URL environment variable not set")
         self.pool = None
+        self.audit_writer = None
+        # Follow LISTEN key_events when other processes change keys (KEY_CACHE_LISTEN or listen=True)
+        # or revoke signed tokens; ``revoked`` is the signer's RevocationList to keep in sync
+        self.revoked = revoked
+        if listen is None:
+            listen = bool(os.environ.get('KEY_CACHE_LISTEN')) or revoked is not None
+        self.listen = listen
+        self.key_filter = KeyFilter(
+            stale_after=float(os.environ.get('KEY_FILTER_STALE_AFTER', 5)) if self.listen else None
+        )
+        self.key_cache = cache_from_env()
+        self.use_counter = counter_from_env()
+        self.breaker = breaker_from_env()
+        self.lookups = AsyncSingleFlight()  # cache-miss lookups shared by concurrent validations of a key
+        # While listening, cached entries are only trusted as long as the feed delivers invalidations
+        self.engine = ValidationEngine(
+            self.key_filter, self.key_cache, self.use_counter,
+            cache_trusted=(lambda: self.key_filter.ready) if self.listen else None
+        )
+        self.acquire_timeout = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+        # Optional read replica for admin listings; validation always reads the primary
+        self.replica_url = os.environ.get('DATABASE_REPLICA_URL')
+        self.replica_pool = None
+        self.replica_max_lag = float(os.environ.get('DB_REPLICA_MAX_LAG', 5))
+        self.replica_lag = None  # None until a lag check succeeds, and after a replica failure
+        self.replica_reads = 0
+        self.replica_fallbacks = 0
+        self._replica_task = None
+        self._flush_task = None
+        self._maintenance_task = None
+        self._listen_conn = None
+        self._key_events_task = None
     
     async def init(self):
         if not self.db_url:
             raise ValueError("DATABASE_URL is not configured")
-        self.pool = await asyncpg.create_pool(self.db_url, min_size=1, max_size=10)
+        # Migrate before the pool exists: its connections prepare statements against the schema
+        await self.init_database()
+        self.pool = await asyncpg.create_pool(
+            self.db_url,
+            min_size=1,
+            max_size=int(os.environ.get('DB_POOL_SIZE', 10)),
+            connection_class=StatementConnection,
+            init=StatementConnection.prepare_registry
+        )
         if self.pool is None:
             raise RuntimeError("Failed to create database pool")
-        await self.init_database()
+        if self.listen:
+            await self._open_key_events()
+            self._key_events_task = asyncio.create_task(self._follow_key_events())
+        else:
+            await self.rebuild_key_filter()
+        self.audit_writer = AsyncAuditWriter(self._write_audit_batch, **audit_settings_from_env()).start()
+        if self.use_counter:
+            self._flush_task = asyncio.create_task(self._flush_use_counts_loop())
+        self._maintenance_task = asyncio.create_task(self._maintenance_loop())
+        if self.replica_url:
+            self._replica_task = asyncio.create_task(self._replica_monitor_loop())
     
     async def close(self):
+        if self._key_events_task:
+            self._key_events_task.cancel()
+        if self._maintenance_task:
+            self._maintenance_task.cancel()
+        if self._replica_task:
+            self._replica_task.cancel()
+        if self.replica_pool:
+            await self.replica_pool.close()
+        if self._flush_task:
+            self._flush_task.cancel()
+            await self.flush_use_counts(release_all=True)
+        if self._listen_conn:
+            await self._listen_conn.close()
+        if self.audit_writer:
+            await self.audit_writer.close()
         if self.pool:
             await self.pool.close()
     
     async def init_database(self):
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS scripts (
-                    id SERIAL PRIMARY KEY,
-                    script_name VARCHAR(255) UNIQUE NOT NULL,
-                    script_id VARCHAR(32) UNIQUE NOT NULL,
-                    description TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS keys (
-                    id SERIAL PRIMARY KEY,
-                    key_code VARCHAR(64) UNIQUE NOT NULL,
-                    script_id VARCHAR(32) NOT NULL,
-                    discord_id BIGINT,
-                    hwid_hash VARCHAR(64),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    expires_at TIMESTAMP,
-                    redeemed_at TIMESTAMP,
-                    max_uses INTEGER DEFAULT -1,
-                    current_uses INTEGER DEFAULT 0,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    note TEXT,
-                    CONSTRAINT fk_script FOREIGN KEY (script_id) REFERENCES scripts(script_id) ON DELETE CASCADE
-                )
-            ''')
-            
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS key_validations (
-                    id SERIAL PRIMARY KEY,
-                    key_code VARCHAR(64) NOT NULL,
-                    discord_id BIGINT,
-                    hwid_hash VARCHAR(64),
-                    validated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    success BOOLEAN NOT NULL,
-                    error_code VARCHAR(50)
+        await prepare_database(self.db_url)
+    
+    @contextlib.asynccontextmanager
+    async def _connection(self):
+        """Acquire a pool connection through the circuit breaker.
+        
+        Timeouts and connection failures, whether acquiring or in the body,
+        count against the breaker and surface as DatabaseUnavailable.
+        """
+        if not self.breaker.allow():
+            raise DatabaseUnavailable('Database is saturated, failing fast')
+        try:
+            acquiring = time.perf_counter()
+            async with self.pool.acquire(timeout=self.acquire_timeout) as conn:
+                PHASE_SECONDS.observe(time.perf_counter() - acquiring, phase='acquire')
+                yield conn
+        except SATURATION_ERRORS as e:
+            self.breaker.record_failure()
+            raise DatabaseUnavailable(str(e) or type(e).__name__) from e
+        except Exception:
+            self.breaker.record_success()  # the database answered, just not happily
+            raise
+        self.breaker.record_success()
+    
+    def connection(self):
+        """A pool connection through the circuit breaker, for stores that run their own queries"""
+        return self._connection()
+    
+    async def _run(self, name, method, *args):
+        """Run the registered statement ``name`` with its timeout"""
+        phase = STATEMENT_PHASES.get(name)
+        timer = PHASE_SECONDS.time(phase=phase) if phase else contextlib.nullcontext()
+        async with self._connection() as conn:
+            with timer:
+                statement = conn.statements[name]
+                try:
+                    return await getattr(statement, method)(*args, timeout=STATEMENTS[name][1])
+                except asyncpg.InvalidCachedStatementError:
+                    # The schema changed under the prepared plan; prepare it again
+                    statement = conn.statements[name] = await conn.prepare(STATEMENTS[name][0])
+                    return await getattr(statement, method)(*args, timeout=STATEMENTS[name][1])
+    
+    async def _check_replica(self):
+        """Connect to the replica if needed and measure its lag; failures mark it unusable"""
+        try:
+            if self.replica_pool is None:
+                self.replica_pool = await asyncpg.create_pool(
+                    self.replica_url,
+                    min_size=1,
+                    max_size=int(os.environ.get('DB_REPLICA_POOL_SIZE', 5)),
+                    timeout=self.acquire_timeout
                 )
-            ''')
+            async with self.replica_pool.acquire(timeout=self.acquire_timeout) as conn:
+                self.replica_lag = await conn.fetchval(REPLICA_LAG_SQL, timeout=STATEMENT_TIMEOUT)
+        except Exception as e:
+            if self.replica_lag is not None:
+                log.warning('Read replica unavailable, reading from the primary', extra={'fields': {'error': str(e)}})
+            self.replica_lag = None
+    
+    async def _replica_monitor_loop(self):
+        interval = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 5))
+        while True:
+            await self._check_replica()
+            await asyncio.sleep(interval)
+    
+    def replica_usable(self):
+        return self.replica_pool is not None and self.replica_lag is not None and self.replica_lag <= self.replica_max_lag
+    
+    async def _read(self, method, sql, *args):
+        """Run a read-only query on the replica while it is within DB_REPLICA_MAX_LAG, else on the primary"""
+        if self.replica_usable():
+            try:
+                async with self.replica_pool.acquire(timeout=self.acquire_timeout) as conn:
+                    result = await getattr(conn, method)(sql, *args, timeout=STATEMENT_TIMEOUT)
+                self.replica_reads += 1
+                return result
+            except (*SATURATION_ERRORS, asyncpg.PostgresConnectionError, asyncpg.InterfaceError) as e:
+                # Stay on the primary until the monitor sees the replica answer again
+                log.warning('Replica read failed, falling back to the primary', extra={'fields': {'error': str(e)}})
+                self.replica_lag = None
+        if self.replica_url:
+            self.replica_fallbacks += 1
+        async with self._connection() as conn:
+            return await getattr(conn, method)(sql, *args)
+    
+    def replica_stats(self):
+        if not self.replica_url:
+            return None
+        return {
+            'usable': self.replica_usable(),
+            'lag_seconds': self.replica_lag,
+            'max_lag_seconds': self.replica_max_lag,
+            'reads': self.replica_reads,
+            'fallbacks': self.replica_fallbacks,
+            'pool_size': self.replica_pool.get_size() if self.replica_pool else 0
+        }
+    
+    async def _maintenance_loop(self):
+        while True:
+            await asyncio.sleep(24 * 60 * 60)
+            try:
+                async with self._connection() as conn:
+                    await maintain_partitions(conn)
+                    await conn.execute('DELETE FROM revoked_tokens WHERE expires <= $1', int(time.time()))
+            except Exception as e:
+                log.error('Database maintenance failed', extra={'fields': {'error': str(e)}})
+    
+    async def _open_key_events(self):
+        """LISTEN key_events, then load the key filter and revocations so no change falls in between"""
+        conn = await asyncpg.connect(self.db_url)
+        try:
+            await conn.add_listener('key_events', self._on_key_event)
+            await self.rebuild_key_filter()
+            if self.revoked is not None:
+                for row in await conn.fetch(load_revoked_sql('numeric'), int(time.time())):
+                    self.revoked.add(row['jti'], row['expires'])
+        except Exception:
+            await conn.close()
+            raise
+        self._listen_conn = conn
+    
+    async def _follow_key_events(self):
+        """Heartbeat the key_events connection, reconnecting and rebuilding after a failure"""
+        rebuilt = time.monotonic()
+        while True:
+            try:
+                if self._listen_conn is None:
+                    await self._open_key_events()
+                    rebuilt = time.monotonic()
+                elif self.key_filter.needs_rebuild() or time.monotonic() - rebuilt >= KEY_FILTER_REBUILD_INTERVAL:
+                    await self.rebuild_key_filter()
+                    rebuilt = time.monotonic()
+                await self._listen_conn.fetchval('SELECT 1', timeout=STATEMENT_TIMEOUT)
+                self.key_filter.touch()
+            except Exception as e:
+                log.error('Key filter feed error', extra={'fields': {'error': str(e)}})
+                self.key_cache.clear()  # invalidations may have been missed
+                if self._listen_conn is not None:
+                    self._listen_conn.terminate()
+                    self._listen_conn = None
+                await asyncio.sleep(5)
+                continue
+            await asyncio.sleep(KEY_EVENTS_POLL_INTERVAL)
+    
+    def _on_key_event(self, conn, pid, channel, payload):
+        apply_key_event(payload, self.key_filter, self.key_cache, self.use_counter, self.revoked)
+    
+    def feed_healthy(self):
+        """True while the key_events feed has delivered recently"""
+        return self.listen and self.key_filter.ready
+    
+    async def revoke_token(self, jti, expires):
+        """Record and broadcast a signed token's revocation; False if it was already revoked"""
+        async with self._connection() as conn:
+            return await conn.fetchrow(revoke_sql('numeric'), jti, expires) is not None
+    
+    async def token_revoked(self, jti):
+        async with self._connection() as conn:
+            return await conn.fetchval('SELECT 1 FROM revoked_tokens WHERE jti = $1', jti) is not None
+    
+    async def rebuild_key_filter(self):
+        started = self.key_filter.begin_rebuild()
+        async with self._connection() as conn:
+            rows = await conn.fetch('SELECT key_code FROM keys')
+        self.key_filter.finish_rebuild((row['key_code'] for row in rows), started)
     
     def generate_key(self, length=32):
         return secrets.token_hex(length // 2).upper()
     
     def hash_hwid(self, hwid):
-        if hwid:
-            return hashlib.sha256(hwid.encode()).hexdigest()
-        return None
+        return hash_hwid(hwid)
     
     async def create_script(self, script_name, description=''):
         script_id = secrets.token_hex(16).upper()
         
         try:
-            async with self.pool.acquire() as conn:
+            async with self._connection() as conn:
                 await conn.execute('''
                     INSERT INTO scripts (script_name, script_id, description)
                     VALUES ($1, $2, $3)
@@ -88,7 +340,7 @@ class KeySystem:
             return {'success': False, 'error': 'Script name already exists'}
     
     async def create_key(self, script_id, discord_id=None, days=None, max_uses=-1, note=''):
-        async with self.pool.acquire() as conn:
+        async with self._connection() as conn:
             script = await conn.fetchrow('SELECT id FROM scripts WHERE script_id = $1', script_id)
             if not script:
                 return {'success': False, 'error': 'Script not found'}
@@ -104,6 +356,12 @@ class KeySystem:
                     VALUES ($1, $2, $3, $4, $5, $6)
                 ''', key_code, script_id, discord_id, expires_at, max_uses, note)
                 
+                # While listening the INSERT event adds it (and the feed rebuilds when needed)
+                if not self.listen:
+                    self.key_filter.add(key_code)
+                    if self.key_filter.needs_rebuild():
+                        asyncio.create_task(self.rebuild_key_filter())
+                
                 return {
                     'success': True,
                     'key': key_code,
@@ -114,8 +372,53 @@ class KeySystem:
             except Exception as e:
                 return {'success': False, 'error': str(e)}
     
+    async def create_keys_bulk(self, script_id, count, days=None, max_uses=-1, note='', chunk_size=1000):
+        """Create ``count`` keys, yielding the new codes one chunk at a time.
+
+        Each chunk is COPYed into a temporary table and moved into keys with
+        ON CONFLICT DO NOTHING; only the codes that collided are regenerated.
+        Raises ValueError if the script does not exist.
+        """
+        expires_at = None
+        if days and days > 0:
+            expires_at = datetime.now() + timedelta(days=days)
+        
+        async with self._connection() as conn:
+            if not await conn.fetchval('SELECT 1 FROM scripts WHERE script_id = $1', script_id):
+                raise ValueError('Script not found')
+            
+            remaining = count
+            while remaining > 0:
+                wanted = min(chunk_size, remaining)
+                created = []
+                while len(created) < wanted:
+                    codes = set()
+                    while len(codes) < wanted - len(created):
+                        codes.add(self.generate_key())
+                    async with conn.transaction():
+                        await conn.execute(
+                            'CREATE TEMPORARY TABLE bulk_keys (key_code VARCHAR(64)) ON COMMIT DROP'
+                        )
+                        await conn.copy_records_to_table('bulk_keys', records=[(code,) for code in codes])
+                        rows = await conn.fetch('''
+                            INSERT INTO keys (key_code, script_id, expires_at, max_uses, note)
+                            SELECT key_code, $1, $2, $3, $4 FROM bulk_keys
+                            ON CONFLICT (key_code) DO NOTHING
+                            RETURNING key_code
+                        ''', script_id, expires_at, max_uses, note)
+                    created.extend(row['key_code'] for row in rows)
+                
+                if not self.listen:
+                    for key_code in created:
+                        self.key_filter.add(key_code)
+                remaining -= len(created)
+                yield created
+        
+        if not self.listen and self.key_filter.needs_rebuild():
+            asyncio.create_task(self.rebuild_key_filter())
+    
     async def redeem_key(self, key_code, discord_id):
-        async with self.pool.acquire() as conn:
+        async with self._connection() as conn:
             key_data = await conn.fetchrow('SELECT * FROM keys WHERE key_code = $1', key_code)
             
             if not key_data:
@@ -136,121 +439,154 @@ class KeySystem:
                     SET discord_id = $1, redeemed_at = CURRENT_TIMESTAMP
                     WHERE key_code = $2
                 ''', discord_id, key_code)
+                self.key_cache.invalidate(key_code)
             
             return {'success': True, 'message': 'Key redeemed successfully'}
     
     async def validate_key(self, key_code, discord_id=None, hwid=None):
-        async with self.pool.acquire() as conn:
-            key_data = await conn.fetchrow('''
-                SELECT k.*, s.script_name
-                FROM keys k
-                JOIN scripts s ON k.script_id = s.script_id
-                WHERE k.key_code = $1
-            ''', key_code)
-            
-            if not key_data:
-                await self._log_validation(conn, key_code, discord_id, hwid, False, 'KEY_NOT_FOUND')
-                return {'valid': False, 'code': 'KEY_NOT_FOUND', 'message': 'Invalid key'}
-            
-            if not key_data['is_active']:
-                await self._log_validation(conn, key_code, discord_id, hwid, False, 'KEY_INACTIVE')
-                return {'valid': False, 'code': 'KEY_INACTIVE', 'message': 'Key is inactive'}
-            
-            if key_data['expires_at'] and datetime.now() > key_data['expires_at']:
-                await self._log_validation(conn, key_code, discord_id, hwid, False, 'KEY_EXPIRED')
-                return {'valid': False, 'code': 'KEY_EXPIRED', 'message': 'Key has expired'}
-            
-            if discord_id and key_data['discord_id'] and key_data['discord_id'] != discord_id:
-                await self._log_validation(conn, key_code, discord_id, hwid, False, 'DISCORD_ID_MISMATCH')
-                return {'valid': False, 'code': 'DISCORD_ID_MISMATCH', 'message': 'Key bound to different Discord user'}
-            
-            if hwid:
-                hwid_hash = self.hash_hwid(hwid)
-                if key_data['hwid_hash'] is None:
-                    await conn.execute('UPDATE keys SET hwid_hash = $1 WHERE key_code = $2', hwid_hash, key_code)
-                elif key_data['hwid_hash'] != hwid_hash:
-                    await self._log_validation(conn, key_code, discord_id, hwid, False, 'HWID_MISMATCH')
-                    return {'valid': False, 'code': 'HWID_MISMATCH', 'message': 'Key bound to different HWID'}
-            
-            if key_data['max_uses'] > 0 and key_data['current_uses'] >= key_data['max_uses']:
-                await self._log_validation(conn, key_code, discord_id, hwid, False, 'MAX_USES_EXCEEDED')
-                return {'valid': False, 'code': 'MAX_USES_EXCEEDED', 'message': 'Key usage limit exceeded'}
-            
-            await conn.execute('UPDATE keys SET current_uses = current_uses + 1 WHERE key_code = $1', key_code)
-            await self._log_validation(conn, key_code, discord_id, hwid, True, 'KEY_VALID')
-            
-            response = {
-                'valid': True,
-                'code': 'KEY_VALID',
-                'message': 'Key is valid',
-                'data': {
-                    'script_name': key_data['script_name'],
-                    'discord_id': key_data['discord_id'],
-                    'expires_at': key_data['expires_at'].isoformat() if key_data['expires_at'] else None,
-                    'current_uses': key_data['current_uses'] + 1,
-                    'max_uses': key_data['max_uses']
-                }
-            }
-            
-            return response
-    
-    async def _log_validation(self, conn, key_code, discord_id, hwid, success, error_code):
-        hwid_hash = self.hash_hwid(hwid) if hwid else None
-        await conn.execute('''
-            INSERT INTO key_validations (key_code, discord_id, hwid_hash, success, error_code)
-            VALUES ($1, $2, $3, $4, $5)
-        ''', key_code, discord_id, hwid_hash, success, error_code)
-    
-    async def get_user_keys(self, discord_id):
-        async with self.pool.acquire() as conn:
-            keys = await conn.fetch('''
-                SELECT k.*, s.script_name
-                FROM keys k
-                JOIN scripts s ON k.script_id = s.script_id
-                WHERE k.discord_id = $1
-                ORDER BY k.created_at DESC
-            ''', discord_id)
-            
-            return [dict(key) for key in keys]
-    
-    async def get_all_keys(self):
-        async with self.pool.acquire() as conn:
-            keys = await conn.fetch('''
-                SELECT k.*, s.script_name
-                FROM keys k
-                JOIN scripts s ON k.script_id = s.script_id
-                ORDER BY k.created_at DESC
-            ''')
-            
-            return [dict(key) for key in keys]
+        try:
+            return await run_async(self.engine.validate(key_code, discord_id, hwid), self._perform)
+        except DatabaseUnavailable:
+            return failure('SERVICE_UNAVAILABLE')
+    
+    async def validate_keys_batch(self, items):
+        """Validate a list of {key, discord_id, hwid} items, returning results in the same order"""
+        try:
+            results, pending = await run_async(self.engine.prepare_batch(items), self._perform)
+        except DatabaseUnavailable:
+            return [failure('SERVICE_UNAVAILABLE') for _ in items]
+        for index, key_code, discord_id, hwid in pending:
+            results[index] = await self.validate_key(key_code, discord_id, hwid)
+        return results
+    
+    async def _perform(self, operation):
+        """Carry out one validation engine operation over the asyncpg pool"""
+        kind = operation[0]
+        if kind == LOOKUP:
+            _, key_code, discord_id, hwid_hash, now, count_in_db, lead = operation
+            lookup = lambda: self._run('validate', 'fetchrow', key_code, discord_id, hwid_hash, now, count_in_db)
+            return await (self.lookups.run(key_code, lookup) if lead else lookup())
+        if kind == JOIN:
+            return await self.lookups.join(operation[1])
+        if kind == RESERVE:
+            return await self._run('reserve', 'fetchrow', operation[1], operation[2])
+        if kind == PREFETCH:
+            return await self._run('prefetch', 'fetch', operation[1])
+        if kind == AUDIT:
+            return await self.audit_writer.submit(operation[1])
+        raise ValueError(f'Unknown validation operation: {kind}')
+    
+    async def flush_use_counts(self, release_all=False):
+        pairs = self.use_counter.drain(release_all)
+        if not pairs:
+            return
+        try:
+            async with self._connection() as conn:
+                await conn.execute(flush_sql(len(pairs), 'numeric'), *[value for pair in pairs for value in pair])
+            self.use_counter.flushes += 1
+        except Exception as e:
+            log.error('Use count flush failed', extra={'fields': {'error': str(e), 'keys': len(pairs)}})
+            self.use_counter.restore(pairs)
+    
+    async def _flush_use_counts_loop(self):
+        interval = float(os.environ.get('USE_FLUSH_INTERVAL', 1))
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush_use_counts()
+    
+    async def _write_audit_batch(self, records):
+        async with self._connection() as conn:
+            with PHASE_SECONDS.time(phase='audit_insert'):
+                await conn.copy_records_to_table('key_validations', records=records, columns=AUDIT_COLUMNS)
+    
+    def gauge_stats(self):
+        """Stats callables for metrics.register_validation_gauges"""
+        return {
+            'db_pool_connections': self.pool_stats,
+            'db_breaker': self.breaker.stats,
+            'db_replica': self.replica_stats,
+            'audit_queue': optional_stats(lambda: self.audit_writer),
+            'key_cache': self.key_cache.stats,
+            'key_filter': self.key_filter.stats,
+            'use_counter': optional_stats(lambda: self.use_counter),
+            'validation_lookups': self.lookups.stats
+        }
+    
+    def pool_stats(self):
+        if self.pool is None:
+            return None
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        return {'size': size, 'idle': idle, 'in_use': size - idle, 'max_size': self.pool.get_max_size()}
+    
+    async def get_keys_page(self, discord_id=None, after=None, limit=10):
+        """One page of keys, newest first.
+
+        ``after`` is the ``next`` cursor of the previous page: a
+        (created_at, id) pair the query seeks past through the index, so
+        every page costs one LIMIT query however deep it is.
+        """
+        conditions = []
+        args = [limit + 1]
+        if discord_id is not None:
+            args.append(discord_id)
+            conditions.append(f'k.discord_id = ${len(args)}')
+        if after is not None:
+            args.extend(after)
+            conditions.append(f'(k.created_at, k.id) < (${len(args) - 1}, ${len(args)})')
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        rows = await self._read('fetch', f'''
+            SELECT k.*, s.script_name
+            FROM keys k
+            JOIN scripts s ON k.script_id = s.script_id
+            {where}
+            ORDER BY k.created_at DESC, k.id DESC
+            LIMIT $1
+        ''', *args)
+        return _page(rows, limit)
+    
+    async def get_scripts_page(self, after=None, limit=10):
+        """One page of scripts, newest first; ``after`` works as in get_keys_page"""
+        if after is None:
+            rows = await self._read(
+                'fetch', 'SELECT * FROM scripts ORDER BY created_at DESC, id DESC LIMIT $1', limit + 1
+            )
+        else:
+            rows = await self._read('fetch', '''
+                SELECT * FROM scripts
+                WHERE (created_at, id) < ($2, $3)
+                ORDER BY created_at DESC, id DESC
+                LIMIT $1
+            ''', limit + 1, *after)
+        return _page(rows, limit)
     
     async def delete_key(self, key_code):
-        async with self.pool.acquire() as conn:
+        async with self._connection() as conn:
             result = await conn.execute('DELETE FROM keys WHERE key_code = $1', key_code)
+            # While listening the DELETE event removes it; removing twice could clear another key's counters
+            if result == 'DELETE 1' and not self.listen:
+                self.key_filter.remove(key_code)
+            if self.use_counter:
+                self.use_counter.forget(key_code)
+            self.key_cache.invalidate(key_code)
             return {'success': result == 'DELETE 1'}
     
     async def reset_hwid(self, key_code):
-        async with self.pool.acquire() as conn:
+        async with self._connection() as conn:
             result = await conn.execute('UPDATE keys SET hwid_hash = NULL WHERE key_code = $1', key_code)
+            self.key_cache.invalidate(key_code)
             return {'success': result == 'UPDATE 1'}
     
-    async def get_all_scripts(self):
-        async with self.pool.acquire() as conn:
-            scripts = await conn.fetch('SELECT * FROM scripts ORDER BY created_at DESC')
-            return [dict(script) for script in scripts]
-    
     async def get_script_by_id(self, script_id):
-        async with self.pool.acquire() as conn:
+        async with self._connection() as conn:
             script = await conn.fetchrow('SELECT * FROM scripts WHERE script_id = $1', script_id)
             return dict(script) if script else None
     
     async def get_key_info(self, key_code):
-        async with self.pool.acquire() as conn:
-            key_data = await conn.fetchrow('''
-                SELECT k.*, s.script_name
-                FROM keys k
-                JOIN scripts s ON k.script_id = s.script_id
-                WHERE k.key_code = $1
-            ''', key_code)
-            
-            return dict(key_data) if key_data else None
+        key_data = await self._read('fetchrow', '''
+            SELECT k.*, s.script_name
+            FROM keys k
+            JOIN scripts s ON k.script_id = s.script_id
+            WHERE k.key_code = $1
+        ''', key_code)
+        return dict(key_data) if key_data else None
@@ -0,0 +1,218 @@
+"""Minimal Prometheus metrics for the validators.
+
+Counters, histograms and gauges render in the Prometheus text format
+(version 0.0.4) from ``REGISTRY.render()``; each server mounts that on
+GET /metrics. Values are per process, so with pre-forked workers every
+scrape reflects the worker that answered it.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [f'{self.name}{_labels(self.labelnames, key)} {_number(value)}' for key, value in values]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        with self._lock:
+            values = sorted((key, list(state)) for key, state in self._values.items())
+        lines = self.header()
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, [("le", _number(bound))])} {cumulative}')
+            lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, [("le", "+Inf")])} {state[-1]}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_number(float(state[-2]))}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {state[-1]}')
+        return lines
+
+
+class Gauge(_Metric):
+    """Read at scrape time from ``collect``, which returns a number or {label values: number}"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def render(self):
+        try:
+            values = self.collect() if self.collect else None
+        except Exception:
+            values = None
+        if values is None:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return self.header() + [
+            f'{self.name}{_labels(self.labelnames, key if isinstance(key, tuple) else (key,))} {_number(value)}'
+            for key, value in sorted(values.items())
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        # Re-registering (e.g. a second server in one process) replaces the collector
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, labelnames=(), collect=None):
+        return self._register(Gauge(name, documentation, labelnames, collect))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+VALIDATIONS = REGISTRY.counter(
+    'key_validations_total', 'Key validations answered, by result code', ['code']
+)
+VALIDATION_SECONDS = REGISTRY.histogram(
+    'key_validation_seconds', 'End-to-end key validation latency'
+)
+PHASE_SECONDS = REGISTRY.histogram(
+    'key_validation_phase_seconds',
+    'Time spent per validation phase (acquire, lookup, update, audit_insert)',
+    ['phase']
+)
+
+
+def record_result(result, seconds=None):
+    """Count one validation result and, if given, its end-to-end latency"""
+    VALIDATIONS.inc(code=result.get('code', 'ERROR'))
+    if seconds is not None:
+        VALIDATION_SECONDS.observe(seconds)
+
+
+def register_stats_gauges(prefix, documentation, stats, labelname='stat'):
+    """Expose the numeric fields of a ``stats()`` dict as one labelled gauge"""
+    def collect():
+        values = stats()
+        if values is None:
+            return None
+        return {(field,): value for field, value in values.items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool)}
+    return REGISTRY.gauge(prefix, documentation, [labelname], collect)
+
+
+# Gauges shared by app.py, bot.py and asgi_app.py: name -> (documentation, label name)
+VALIDATION_GAUGES = {
+    'db_pool_connections': ('Database pool connections by state', 'state'),
+    'db_breaker': ('Database circuit breaker counts', 'stat'),
+    'db_replica': ('Read replica lag, reads and primary fallbacks', 'stat'),
+    'audit_queue': ('Audit writer queue and outcome counts', 'stat'),
+    'notifier': ('Discord notification queue depth and outcome counts', 'stat'),
+    'key_cache': ('Key cache size and hit counts', 'stat'),
+    'key_filter': ('Key filter state', 'stat'),
+    'use_counter': ('Write-behind use counter state', 'stat'),
+    'validation_lookups': ('Cache-miss lookups led and joined by concurrent validations', 'stat'),
+    'validation_tokens': ('Executor token store counts', 'stat'),
+    'rate_limiter': ('Rate limiter buckets and rejections by dimension', 'stat')
+}
+
+
+def optional_stats(get):
+    """``stats`` of whatever ``get()`` returns, or None while that is None"""
+    def stats():
+        component = get()
+        return component.stats() if component is not None else None
+    return stats
+
+
+def register_validation_gauges(**stats):
+    """Register the VALIDATION_GAUGES named by the keyword arguments, each a ``stats()`` callable"""
+    for name, stats_fn in stats.items():
+        documentation, labelname = VALIDATION_GAUGES[name]
+        register_stats_gauges(name, documentation, stats_fn, labelname)
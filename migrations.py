@@ -0,0 +1,375 @@
+"""Versioned schema migrations for the key system database.
+
+Each migration is applied once, in its own transaction, and recorded in
+``schema_migrations``. Append new migrations to MIGRATIONS; never edit one
+that has shipped.
+"""
+import os
+from datetime import datetime, timedelta
+
+import asyncpg
+
+from structured_log import get_logger
+
+log = get_logger('migrations')
+
+# Serialises migrations when several processes start at once
+MIGRATION_LOCK_ID = 7243015
+# Lets one process at a time do partition upkeep; the others skip it
+UPKEEP_LOCK_ID = 7243016
+
+SCHEMA_MIGRATIONS_SQL = '''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+BASE_TABLES = [
+    '''
+    CREATE TABLE IF NOT EXISTS scripts (
+        id SERIAL PRIMARY KEY,
+        script_name VARCHAR(255) UNIQUE NOT NULL,
+        script_id VARCHAR(32) UNIQUE NOT NULL,
+        description TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS keys (
+        id SERIAL PRIMARY KEY,
+        key_code VARCHAR(64) UNIQUE NOT NULL,
+        script_id VARCHAR(32) NOT NULL,
+        discord_id BIGINT,
+        hwid_hash VARCHAR(64),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        expires_at TIMESTAMP,
+        redeemed_at TIMESTAMP,
+        max_uses INTEGER DEFAULT -1,
+        current_uses INTEGER DEFAULT 0,
+        is_active BOOLEAN DEFAULT TRUE,
+        note TEXT,
+        CONSTRAINT fk_script FOREIGN KEY (script_id) REFERENCES scripts(script_id) ON DELETE CASCADE
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS key_validations (
+        id SERIAL PRIMARY KEY,
+        key_code VARCHAR(64) NOT NULL,
+        discord_id BIGINT,
+        hwid_hash VARCHAR(64),
+        validated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        success BOOLEAN NOT NULL,
+        error_code VARCHAR(50)
+    )
+    '''
+]
+
+KEY_FUNCTIONS = [
+    'DROP FUNCTION IF EXISTS validate_key_atomic(VARCHAR, BIGINT, VARCHAR, TIMESTAMP)',
+    'DROP FUNCTION IF EXISTS validate_key_atomic(VARCHAR, BIGINT, VARCHAR, TIMESTAMP, BOOLEAN)',
+    '''
+    CREATE FUNCTION validate_key_atomic(
+        p_key_code VARCHAR,
+        p_discord_id BIGINT,
+        p_hwid_hash VARCHAR,
+        p_now TIMESTAMP,
+        p_count_uses BOOLEAN DEFAULT TRUE
+    )
+    RETURNS TABLE (
+        code VARCHAR,
+        script_name VARCHAR,
+        discord_id BIGINT,
+        expires_at TIMESTAMP,
+        current_uses INTEGER,
+        max_uses INTEGER,
+        hwid_hash VARCHAR,
+        is_active BOOLEAN
+    )
+    LANGUAGE plpgsql AS $$
+    #variable_conflict use_column
+    DECLARE
+        k RECORD;
+    BEGIN
+        SELECT keys.id, keys.discord_id, keys.hwid_hash, keys.expires_at,
+               keys.current_uses, keys.max_uses, keys.is_active, s.script_name
+        INTO k
+        FROM keys
+        JOIN scripts s ON keys.script_id = s.script_id
+        WHERE keys.key_code = p_key_code
+        FOR UPDATE OF keys;
+
+        IF NOT FOUND THEN
+            code := 'KEY_NOT_FOUND';
+        ELSIF NOT k.is_active THEN
+            code := 'KEY_INACTIVE';
+        ELSIF k.expires_at IS NOT NULL AND p_now > k.expires_at THEN
+            code := 'KEY_EXPIRED';
+        ELSIF p_discord_id IS NOT NULL AND k.discord_id IS NOT NULL AND k.discord_id <> p_discord_id THEN
+            code := 'DISCORD_ID_MISMATCH';
+        ELSIF p_hwid_hash IS NOT NULL AND k.hwid_hash IS NOT NULL AND k.hwid_hash <> p_hwid_hash THEN
+            code := 'HWID_MISMATCH';
+        ELSIF p_count_uses AND k.max_uses > 0 AND k.current_uses >= k.max_uses THEN
+            code := 'MAX_USES_EXCEEDED';
+        ELSE
+            code := 'KEY_VALID';
+        END IF;
+
+        IF FOUND THEN
+            script_name := k.script_name;
+            discord_id := k.discord_id;
+            expires_at := k.expires_at;
+            current_uses := k.current_uses;
+            max_uses := k.max_uses;
+            hwid_hash := k.hwid_hash;
+            is_active := k.is_active;
+        END IF;
+
+        IF code = 'KEY_VALID' AND p_count_uses THEN
+            UPDATE keys
+            SET current_uses = keys.current_uses + 1,
+                hwid_hash = COALESCE(keys.hwid_hash, p_hwid_hash)
+            WHERE keys.id = k.id
+            RETURNING keys.current_uses, keys.hwid_hash INTO current_uses, hwid_hash;
+        ELSIF code = 'KEY_VALID' AND p_hwid_hash IS NOT NULL AND k.hwid_hash IS NULL
+              AND NOT (k.max_uses > 0 AND k.current_uses >= k.max_uses) THEN
+            -- Uses are counted by the caller's write-behind counter; an exhausted key binds nothing
+            UPDATE keys SET hwid_hash = p_hwid_hash WHERE keys.id = k.id;
+            hwid_hash := p_hwid_hash;
+        END IF;
+
+        RETURN NEXT;
+    END;
+    $$
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION notify_key_change() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('key_events', 'DELETE:' || OLD.key_code);
+            RETURN OLD;
+        END IF;
+        PERFORM pg_notify('key_events', TG_OP || ':' || NEW.key_code);
+        RETURN NEW;
+    END;
+    $$
+    ''',
+    'DROP TRIGGER IF EXISTS keys_notify_change ON keys',
+    '''
+    CREATE TRIGGER keys_notify_change
+    AFTER INSERT OR DELETE ON keys
+    FOR EACH ROW EXECUTE FUNCTION notify_key_change()
+    ''',
+    'DROP TRIGGER IF EXISTS keys_notify_update ON keys',
+    '''
+    CREATE TRIGGER keys_notify_update
+    AFTER UPDATE OF hwid_hash, discord_id, is_active, expires_at, max_uses, script_id ON keys
+    FOR EACH ROW
+    WHEN (OLD.hwid_hash IS DISTINCT FROM NEW.hwid_hash
+          OR OLD.discord_id IS DISTINCT FROM NEW.discord_id
+          OR OLD.is_active IS DISTINCT FROM NEW.is_active
+          OR OLD.expires_at IS DISTINCT FROM NEW.expires_at
+          OR OLD.max_uses IS DISTINCT FROM NEW.max_uses
+          OR OLD.script_id IS DISTINCT FROM NEW.script_id)
+    EXECUTE FUNCTION notify_key_change()
+    '''
+]
+
+KEY_INDEXES = [
+    # get_user_keys: WHERE discord_id = $1 ORDER BY created_at DESC
+    'CREATE INDEX IF NOT EXISTS idx_keys_discord_id ON keys (discord_id, created_at DESC)',
+    # Script listings and the ON DELETE CASCADE from scripts
+    'CREATE INDEX IF NOT EXISTS idx_keys_script_id ON keys (script_id)'
+]
+
+# Keyset pagination seeks on (created_at, id), which needs both non-null
+PAGINATION_INDEXES = [
+    'UPDATE keys SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL',
+    'ALTER TABLE keys ALTER COLUMN created_at SET NOT NULL',
+    'UPDATE scripts SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL',
+    'ALTER TABLE scripts ALTER COLUMN created_at SET NOT NULL',
+    'CREATE INDEX IF NOT EXISTS idx_keys_created ON keys (created_at DESC, id DESC)',
+    # Supersedes idx_keys_discord_id for get_user_keys and ?mykeys paging
+    'CREATE INDEX IF NOT EXISTS idx_keys_discord_created ON keys (discord_id, created_at DESC, id DESC)',
+    'DROP INDEX IF EXISTS idx_keys_discord_id',
+    'CREATE INDEX IF NOT EXISTS idx_scripts_created ON scripts (created_at DESC, id DESC)'
+]
+
+
+# Executor tokens; UNLOGGED because losing them in a crash only means re-running ?validate
+VALIDATION_TOKENS = [
+    '''
+    CREATE UNLOGGED TABLE IF NOT EXISTS validation_tokens (
+        token VARCHAR(32) PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        key_prefix VARCHAR(8),
+        issued_at TIMESTAMP NOT NULL,
+        expires_at TIMESTAMP NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_validation_tokens_expires ON validation_tokens (expires_at)'
+]
+
+# Signed executor tokens revoked before they expire; expires is unix seconds like the token's exp
+REVOKED_TOKENS = [
+    '''
+    CREATE TABLE IF NOT EXISTS revoked_tokens (
+        jti VARCHAR(32) PRIMARY KEY,
+        expires BIGINT NOT NULL
+    )
+    '''
+]
+
+
+def _month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def _next_month(value):
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"key_validations_p{month.year:04d}_{month.month:02d}"
+
+
+async def _create_partition(conn, month):
+    await conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {partition_name(month)}
+        PARTITION OF key_validations
+        FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{_next_month(month):%Y-%m-%d}')
+    ''')
+
+
+async def _partition_key_validations(conn):
+    """Rebuild key_validations as a table range-partitioned by month"""
+    await conn.execute('ALTER TABLE key_validations RENAME TO key_validations_legacy')
+    await conn.execute('ALTER SEQUENCE IF EXISTS key_validations_id_seq RENAME TO key_validations_legacy_id_seq')
+    await conn.execute('ALTER INDEX IF EXISTS key_validations_pkey RENAME TO key_validations_legacy_pkey')
+    await conn.execute('''
+        CREATE TABLE key_validations (
+            id BIGSERIAL,
+            key_code VARCHAR(64) NOT NULL,
+            discord_id BIGINT,
+            hwid_hash VARCHAR(64),
+            validated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            success BOOLEAN NOT NULL,
+            error_code VARCHAR(50),
+            PRIMARY KEY (id, validated_at)
+        ) PARTITION BY RANGE (validated_at)
+    ''')
+    # Catches rows outside every monthly partition instead of failing the insert
+    await conn.execute('CREATE TABLE key_validations_default PARTITION OF key_validations DEFAULT')
+
+    oldest = await conn.fetchval('SELECT MIN(validated_at) FROM key_validations_legacy')
+    month = _month_start(oldest or datetime.now())
+    last = _month_start(datetime.now())
+    while month <= last:
+        await _create_partition(conn, month)
+        month = _next_month(month)
+
+    await conn.execute('''
+        INSERT INTO key_validations (id, key_code, discord_id, hwid_hash, validated_at, success, error_code)
+        SELECT id, key_code, discord_id, hwid_hash, COALESCE(validated_at, CURRENT_TIMESTAMP), success, error_code
+        FROM key_validations_legacy
+    ''')
+    await conn.execute('''
+        SELECT setval('key_validations_id_seq', COALESCE((SELECT MAX(id) FROM key_validations), 0) + 1, false)
+    ''')
+    await conn.execute('DROP TABLE key_validations_legacy')
+
+    await conn.execute('CREATE INDEX idx_key_validations_key_code ON key_validations (key_code, validated_at DESC)')
+    await conn.execute('CREATE INDEX idx_key_validations_validated_at ON key_validations (validated_at)')
+
+
+# (version, name, steps); a step is SQL or an async callable taking the connection
+MIGRATIONS = [
+    (1, 'base tables', BASE_TABLES),
+    (2, 'validate_key_atomic and key_events triggers', KEY_FUNCTIONS),
+    (3, 'keys lookup indexes', KEY_INDEXES),
+    (4, 'partition key_validations by month', [_partition_key_validations]),
+    (5, 'keyset pagination indexes', PAGINATION_INDEXES),
+    (6, 'validation_tokens table', VALIDATION_TOKENS),
+    (7, 'revoked_tokens table', REVOKED_TOKENS)
+]
+
+
+async def migrate(conn):
+    """Apply every migration newer than the database's schema version"""
+    await conn.execute('SELECT pg_advisory_lock($1)', MIGRATION_LOCK_ID)
+    try:
+        await conn.execute(SCHEMA_MIGRATIONS_SQL)
+        applied = {row['version'] for row in await conn.fetch('SELECT version FROM schema_migrations')}
+        for version, name, steps in MIGRATIONS:
+            if version in applied:
+                continue
+            async with conn.transaction():
+                for step in steps:
+                    if callable(step):
+                        await step(conn)
+                    else:
+                        await conn.execute(step)
+                await conn.execute(
+                    'INSERT INTO schema_migrations (version, name) VALUES ($1, $2)', version, name
+                )
+            log.info('Applied migration', extra={'fields': {'version': version, 'name': name}})
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATION_LOCK_ID)
+
+
+async def ensure_partitions(conn, months_ahead=2):
+    """Create this month's key_validations partition and the next few"""
+    month = _month_start(datetime.now())
+    for _ in range(months_ahead + 1):
+        await _create_partition(conn, month)
+        month = _next_month(month)
+
+
+async def drop_expired_partitions(conn, retention_days):
+    """Drop monthly partitions whose rows are all older than ``retention_days``"""
+    if not retention_days:
+        return []
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    rows = await conn.fetch('''
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'key_validations' AND c.relname LIKE 'key_validations\\_p%'
+    ''')
+    dropped = []
+    for row in rows:
+        try:
+            month = datetime.strptime(row['relname'], 'key_validations_p%Y_%m')
+        except ValueError:
+            continue
+        if _next_month(month) <= cutoff:
+            await conn.execute(f'DROP TABLE IF EXISTS {row["relname"]}')
+            dropped.append(row['relname'])
+    return dropped
+
+
+async def maintain_partitions(conn):
+    """Partition upkeep run at startup and then daily, skipped while another process is doing it"""
+    if not await conn.fetchval('SELECT pg_try_advisory_lock($1)', UPKEEP_LOCK_ID):
+        return
+    try:
+        await ensure_partitions(conn, int(os.environ.get('AUDIT_PARTITIONS_AHEAD', 2)))
+        # Opt-in: AUDIT_RETENTION_DAYS=N drops whole months of audit rows older than N days; 0 keeps them all
+        dropped = await drop_expired_partitions(conn, int(os.environ.get('AUDIT_RETENTION_DAYS', 0)))
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', UPKEEP_LOCK_ID)
+    for name in dropped:
+        log.info('Dropped expired audit partition', extra={'fields': {'partition': name}})
+
+
+async def prepare_database(db_url):
+    """Migrate and run partition upkeep over a dedicated connection; every server calls this at startup"""
+    conn = await asyncpg.connect(db_url)
+    try:
+        await migrate(conn)
+        await maintain_partitions(conn)
+    finally:
+        await conn.close()
@@ -0,0 +1,198 @@
+import os
+import threading
+import time
+from collections import Counter, deque
+
+import requests
+
+DISCORD_API = 'https://discord.com/api/v10'
+
+
+def mask_key(key_code):
+    return f"{key_code[:8]}...{key_code[-4:]}"
+
+
+def validation_embed(key_code, valid, user_id=None, error_code=None):
+    """The per-validation embed the validator has always posted"""
+    if valid:
+        return {
+            "title": "✅ Key Validation Successful",
+            "description": "A key was successfully validated",
+            "color": 65280,
+            "fields": [
+                {"name": "Key (masked)", "value": f"`{mask_key(key_code)}`", "inline": True},
+                {"name": "User ID", "value": str(user_id) if user_id else "Unknown", "inline": True},
+            ]
+        }
+    return {
+        "title": "❌ Key Validation Failed",
+        "description": "A key validation attempt failed",
+        "color": 16711680,
+        "fields": [
+            {"name": "Key (masked)", "value": f"`{mask_key(key_code)}`", "inline": True},
+            {"name": "Reason", "value": error_code or "Unknown error", "inline": True},
+        ]
+    }
+
+
+def summary_embed(events, window):
+    """One embed standing in for a burst of validations"""
+    succeeded = sum(1 for event in events if event[1])
+    failed = len(events) - succeeded
+    reasons = Counter(event[3] or 'Unknown error' for event in events if not event[1])
+    recent = '\n'.join(
+        f"{'✅' if valid else '❌'} `{mask_key(key_code)}`" for key_code, valid, _, _ in events[-10:]
+    )
+    fields = [
+        {"name": "Successful", "value": str(succeeded), "inline": True},
+        {"name": "Failed", "value": str(failed), "inline": True},
+    ]
+    if reasons:
+        fields.append({
+            "name": "Failure reasons",
+            "value": '\n'.join(f"{code}: {count}" for code, count in reasons.most_common(10)),
+            "inline": False
+        })
+    fields.append({"name": f"Latest {min(len(events), 10)}", "value": recent, "inline": False})
+    return {
+        "title": f"📊 {len(events)} Key Validations",
+        "description": f"Validations in the last {window:g}s",
+        "color": 65280 if not failed else 16753920 if succeeded else 16711680,
+        "fields": fields
+    }
+
+
+class NotificationDispatcher:
+    """Single background sender for validation notifications.
+
+    Events are queued (dropped once ``max_queue`` is reached) and collected
+    for ``coalesce_window`` seconds; a lone event is posted as the usual
+    embed, a burst as one summary embed. Posts share a keep-alive
+    ``requests.Session`` and honour Discord's Retry-After on 429s.
+    """
+
+    def __init__(self, bot_token, channel_id, max_queue=1000, coalesce_window=2.0, max_retries=3):
+        self.bot_token = bot_token
+        self.channel_id = channel_id
+        self.max_queue = max_queue
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._session = None
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+    def start(self):
+        if self._thread is None and self.bot_token:
+            self._thread = threading.Thread(target=self._run, name='discord-notifier', daemon=True)
+            self._thread.start()
+        return self
+
+    def submit(self, key_code, valid, user_id=None, error_code=None):
+        if not self.bot_token:
+            return
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                return
+            self._queue.append((key_code, valid, user_id, error_code))
+            self._cond.notify()
+
+    def depth(self):
+        return len(self._queue)
+
+    def _collect(self):
+        with self._cond:
+            while not self._queue and not self._stopping:
+                self._cond.wait()
+            if not self._queue:
+                return []
+        if not self._stopping:
+            time.sleep(self.coalesce_window)
+        with self._cond:
+            events = list(self._queue)
+            self._queue.clear()
+        return events
+
+    def _run(self):
+        while True:
+            events = self._collect()
+            if not events:
+                return
+            if len(events) == 1:
+                embed = validation_embed(*events[0])
+            else:
+                embed = summary_embed(events, self.coalesce_window)
+            self._post({"embeds": [embed]})
+
+    def _post(self, payload):
+        if self._session is None:
+            self._session = requests.Session()
+            self._session.headers.update({
+                'Authorization': f'Bot {self.bot_token}',
+                'Content-Type': 'application/json'
+            })
+        url = f"{DISCORD_API}/channels/{self.channel_id}/messages"
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self._session.post(url, json=payload, timeout=5)
+            except requests.RequestException:
+                time.sleep(2 ** attempt)
+                continue
+            if response.status_code == 429:
+                self.rate_limited += 1
+                time.sleep(_retry_after(response))
+                continue
+            if response.status_code >= 500:
+                time.sleep(2 ** attempt)
+                continue
+            if response.ok:
+                self.sent += 1
+            else:
+                self.failed += 1
+            return
+        self.failed += 1
+
+    def close(self, timeout=10.0):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        return {
+            'queued': len(self._queue),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'rate_limited': self.rate_limited
+        }
+
+
+def _retry_after(response):
+    """Seconds to wait from a 429, preferring the JSON body's sub-second value"""
+    try:
+        return float(response.json().get('retry_after'))
+    except (ValueError, TypeError, AttributeError):
+        pass
+    try:
+        return float(response.headers.get('Retry-After', 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+def dispatcher_from_env(channel_id):
+    return NotificationDispatcher(
+        os.environ.get('DISCORD_BOT_TOKEN'),
+        channel_id,
+        max_queue=int(os.environ.get('NOTIFY_QUEUE_SIZE', 1000)),
+        coalesce_window=float(os.environ.get('NOTIFY_COALESCE_SECONDS', 2))
+    )
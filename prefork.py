@@ -0,0 +1,160 @@
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+log = logging.getLogger('prefork')
+
+
+class _InFlight:
+    """WSGI middleware counting requests in progress so a worker can drain"""
+
+    def __init__(self, app):
+        self.app = app
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.count += 1
+        try:
+            return self.app(environ, start_response)
+        finally:
+            with self._lock:
+                self.count -= 1
+
+
+def _run_worker(sock, app, host, port, post_fork, worker_exit, graceful_timeout):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the master coordinates Ctrl+C
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)  # reloads are driven by the master
+    if post_fork:
+        post_fork()
+
+    tracked = _InFlight(app)
+    server = make_server(host, port, tracked, threaded=True, fd=sock.fileno())
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    finally:
+        # serve_forever returned: the listening socket is no longer polled,
+        # let requests that were already accepted finish
+        deadline = time.monotonic() + graceful_timeout
+        while tracked.count and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if worker_exit:
+            worker_exit()
+
+
+def _spawn(sock, app, host, port, post_fork, worker_exit, graceful_timeout):
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 0
+    try:
+        _run_worker(sock, app, host, port, post_fork, worker_exit, graceful_timeout)
+    except Exception as e:
+        log.exception('Worker crashed')
+        code = 1
+    finally:
+        logging.shutdown()  # os._exit skips atexit; drain queued log records first
+        sys.stdout.flush()
+        os._exit(code)
+
+
+def serve(app, host='0.0.0.0', port=5000, workers=None, post_fork=None, worker_exit=None,
+          graceful_timeout=30.0):
+    """Run ``app`` in ``workers`` pre-forked processes sharing one listening socket.
+
+    ``post_fork`` runs in each worker before it accepts requests (create
+    per-process resources such as connection pools there) and
+    ``worker_exit`` after it has drained. SIGTERM/SIGINT drain and stop all
+    workers; SIGHUP starts a fresh set of workers, then drains the old ones;
+    workers that die are respawned.
+    """
+    workers = workers or os.cpu_count() or 1
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+
+    def spawn():
+        return _spawn(sock, app, host, port, post_fork, worker_exit, graceful_timeout)
+
+    children = {spawn(): time.monotonic() for _ in range(workers)}
+    state = {'stopping': False, 'reload': False}
+
+    def on_stop(signum, frame):
+        state['stopping'] = True
+
+    def on_reload(signum, frame):
+        state['reload'] = True
+
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+    signal.signal(signal.SIGHUP, on_reload)
+    log.info('Workers serving', extra={'fields': {'workers': workers, 'url': f'http://{host}:{port}', 'master_pid': os.getpid()}})
+
+    retiring = set()
+    crashes = 0
+    while not state['stopping']:
+        if state['reload']:
+            state['reload'] = False
+            # Start the replacements first so the socket is never left unserved
+            old = set(children) - retiring
+            children.update({spawn(): time.monotonic() for _ in range(workers)})
+            for pid in old:
+                _signal(pid, signal.SIGTERM)
+            retiring |= old
+
+        pid = _reap()
+        if pid is None:
+            time.sleep(0.5)
+            continue
+        started = children.pop(pid, None)
+        if pid in retiring:
+            retiring.discard(pid)
+        elif started is not None and not state['stopping']:
+            # Back off when workers die right after starting (bad config, DB down)
+            crashes = crashes + 1 if time.monotonic() - started < 5 else 0
+            log.warning('Worker exited, respawning', extra={'fields': {'worker_pid': pid}})
+            time.sleep(min(crashes, 10))
+            children[spawn()] = time.monotonic()
+
+    for pid in children:
+        _signal(pid, signal.SIGTERM)
+    deadline = time.monotonic() + graceful_timeout
+    while children and time.monotonic() < deadline:
+        pid = _reap()
+        if pid is None:
+            time.sleep(0.1)
+        else:
+            children.pop(pid, None)
+    for pid in children:
+        _signal(pid, signal.SIGKILL)
+    sock.close()
+
+
+def _signal(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+def _reap():
+    try:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+    except ChildProcessError:
+        return None
+    return pid or None
@@ -0,0 +1,185 @@
+"""Token-bucket rate limiting for the validation endpoints.
+
+Each request draws from up to three buckets: the client IP, the hwid and
+the key. Only the IP is limited by default; the hwid and key limits are
+opt-in through RATE_LIMIT_HWID and RATE_LIMIT_KEY. A bucket refills at
+``rate`` tokens per second up to ``burst``; an empty bucket answers
+RATE_LIMITED without touching the database.
+
+Behind a reverse proxy every request arrives from the proxy's address, so
+set RATE_LIMIT_PROXY_HOPS to the number of proxies that append to
+X-Forwarded-For or all clients share one IP bucket. It defaults to 1 on
+Render (which sets RENDER for its services) and 0 elsewhere; keep it at 0
+when clients connect directly, since the header is then client-supplied
+and cannot be trusted.
+Buckets live in a bounded store: ``LocalBuckets`` (per process, LRU
+evicted) or ``SharedBuckets`` (a fixed slot table in shared memory that
+pre-forked app.py workers inherit, so they enforce one limit together).
+"""
+import hashlib
+import math
+import mmap
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+RATE_LIMITED_MESSAGE = 'Too many requests, slow down'
+
+# Checked in this order; the first empty bucket rejects the request
+DIMENSIONS = ('ip', 'hwid', 'key')
+DEFAULT_RULES = {'ip': '20:40', 'hwid': 'off', 'key': 'off'}
+
+
+def _refill(tokens, last, now, rate, burst, cost):
+    """Returns (tokens left, seconds until ``cost`` tokens are available or 0)"""
+    tokens = min(burst, tokens + (now - last) * rate)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / rate
+
+
+class LocalBuckets:
+    """Per-process buckets in an OrderedDict, least recently used evicted past ``max_size``"""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self.evictions = 0
+
+    def take(self, name, rate, burst, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            state = self._buckets.get(name)
+            tokens, last = state if state is not None else (burst, now)
+            tokens, retry_after = _refill(tokens, last, now, rate, burst, cost)
+            self._buckets[name] = (tokens, now)
+            self._buckets.move_to_end(name)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+        return retry_after
+
+    def stats(self):
+        return {'backend': 'local', 'buckets': len(self._buckets), 'max_size': self.max_size,
+                'evictions': self.evictions}
+
+
+class SharedBuckets:
+    """Buckets in an anonymous shared mapping, visible to every process forked after creation.
+
+    Bucket names hash to one of ``slots`` fixed-size slots. A slot holding
+    another bucket's fingerprint is taken over with a full bucket, so memory
+    never grows and a collision can only loosen a limit, never tighten it.
+    """
+
+    SLOT = struct.Struct('Qdd')  # fingerprint, tokens, last refill (monotonic)
+
+    def __init__(self, slots=100000):
+        self.slots = slots
+        self._memory = mmap.mmap(-1, slots * self.SLOT.size)
+        self._lock = multiprocessing.Lock()
+        self.evictions = 0
+
+    def take(self, name, rate, burst, cost=1):
+        fingerprint = int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), 'big')
+        offset = (fingerprint % self.slots) * self.SLOT.size
+        now = time.monotonic()
+        with self._lock:
+            stored, tokens, last = self.SLOT.unpack_from(self._memory, offset)
+            if stored != fingerprint:
+                if stored:
+                    self.evictions += 1
+                tokens, last = burst, now
+            tokens, retry_after = _refill(tokens, last, now, rate, burst, cost)
+            self.SLOT.pack_into(self._memory, offset, fingerprint, tokens, now)
+        return retry_after
+
+    def stats(self):
+        return {'backend': 'shared', 'max_size': self.slots, 'evictions': self.evictions}
+
+
+class RateLimiter:
+    """Applies the per-dimension ``rules`` ({dimension: (rate, burst)}) to requests"""
+
+    def __init__(self, buckets, rules, proxy_hops=0):
+        self.buckets = buckets
+        self.rules = rules
+        self.proxy_hops = proxy_hops
+        self.limited = {dimension: 0 for dimension in DIMENSIONS}
+
+    def client_ip(self, peer, forwarded_for=None):
+        """The address ``proxy_hops`` trusted proxies saw; the peer address when not behind one"""
+        if self.proxy_hops and forwarded_for:
+            hops = [hop.strip() for hop in forwarded_for.split(',') if hop.strip()]
+            if len(hops) >= self.proxy_hops:
+                return hops[-self.proxy_hops]
+        return peer
+
+    def check(self, ip=None, key_code=None, hwid=None, cost=1):
+        """None if the request may go ahead, else a RATE_LIMITED result"""
+        for dimension, value in zip(DIMENSIONS, (ip, hwid, key_code)):
+            rule = self.rules.get(dimension)
+            if rule is None or not value:
+                continue
+            rate, burst = rule
+            # A cost above the burst could never be paid; charge a full bucket instead
+            retry_after = self.buckets.take(f'{dimension}:{value}'[:160], rate, burst, min(cost, burst))
+            if retry_after:
+                self.limited[dimension] += 1
+                return {'valid': False, 'code': 'RATE_LIMITED', 'message': RATE_LIMITED_MESSAGE,
+                        'retry_after': round(retry_after, 2)}
+        return None
+
+    def check_items(self, items):
+        """``check`` each batch item's key and hwid; None marks the items that may go ahead"""
+        return [
+            self.check(key_code=str(item.get('key') or '').strip(), hwid=str(item.get('hwid') or '').strip())
+            if isinstance(item, dict) else None
+            for item in items
+        ]
+
+    def stats(self):
+        stats = self.buckets.stats()
+        stats.update({f'limited_{dimension}': count for dimension, count in self.limited.items()})
+        return stats
+
+
+def retry_after_header(result):
+    return str(math.ceil(result['retry_after']))
+
+
+def merge_batch_results(limited, results):
+    """Put the validated ``results`` back between the RATE_LIMITED ones, in item order"""
+    results = iter(results)
+    return [result if result is not None else next(results) for result in limited]
+
+
+def _rule(spec):
+    """'rate:burst' (tokens per second, bucket size); 'off' disables the dimension"""
+    if spec.strip().lower() in ('', '0', 'off'):
+        return None
+    rate, _, burst = spec.partition(':')
+    rate = float(rate)
+    return rate, float(burst) if burst else max(rate, 1.0)
+
+
+def limiter_from_env():
+    """None when RATE_LIMIT=off; RATE_LIMIT_IP/_HWID/_KEY take 'rate:burst' or 'off'.
+
+    RATE_LIMIT_PROXY_HOPS (default 1 on Render, else 0) is how many trusted
+    proxies sit in front of the server; see the module docstring.
+    """
+    if os.environ.get('RATE_LIMIT', 'on').lower() in ('0', 'off', 'false'):
+        return None
+    size = int(os.environ.get('RATE_LIMIT_SIZE', 100000))
+    shared = os.environ.get('RATE_LIMIT_SHARED', '').lower() in ('1', 'true', 'yes')
+    return RateLimiter(
+        SharedBuckets(size) if shared else LocalBuckets(size),
+        {dimension: _rule(os.environ.get(f'RATE_LIMIT_{dimension.upper()}', DEFAULT_RULES[dimension]))
+         for dimension in DIMENSIONS},
+        proxy_hops=int(os.environ.get('RATE_LIMIT_PROXY_HOPS', 1 if os.environ.get('RENDER') else 0))
+    )
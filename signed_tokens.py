@@ -0,0 +1,144 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+
+from token_store import TOKEN_TTL
+
+
+# Records a revocation and tells every validator through the key_events feed.
+# Returns no row if the token was already revoked, which makes consume single-use.
+REVOKE_SQL = '''
+    WITH revoked AS (
+        INSERT INTO revoked_tokens (jti, expires) VALUES ({0}, {1})
+        ON CONFLICT (jti) DO NOTHING
+        RETURNING jti, expires
+    )
+    SELECT jti, pg_notify('key_events', 'REVOKE:' || jti || ':' || expires) FROM revoked
+'''
+
+LOAD_REVOKED_SQL = 'SELECT jti, expires FROM revoked_tokens WHERE expires > {0}'
+
+
+def revoke_sql(style='format'):
+    return REVOKE_SQL.format(*(('$1', '$2') if style == 'numeric' else ('%s', '%s')))
+
+
+def load_revoked_sql(style='format'):
+    return LOAD_REVOKED_SQL.format('$1' if style == 'numeric' else '%s')
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def is_signed_token(token):
+    """Signed tokens are kid.payload.signature; the stored hex tokens have no dots"""
+    return token.count('.') == 2
+
+
+class RevocationList:
+    """Token IDs revoked before their expiry, kept only until they would expire anyway"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._revoked = {}
+        self._prune_at = 64
+
+    def add(self, jti, expires):
+        with self._lock:
+            self._revoked[jti] = expires
+            if len(self._revoked) >= self._prune_at:
+                # Amortised: prune only once the list has doubled since the last pass
+                now = time.time()
+                self._revoked = {jti: exp for jti, exp in self._revoked.items() if exp > now}
+                self._prune_at = max(64, len(self._revoked) * 2)
+
+    def __contains__(self, jti):
+        return jti in self._revoked
+
+    def __len__(self):
+        return len(self._revoked)
+
+
+class TokenSigner:
+    """Stateless executor tokens signed with HMAC-SHA256.
+
+    A token carries the Discord user, key prefix, optional HWID hash and
+    expiry, so any process holding the signing keys can verify it without
+    a lookup. ``keys`` maps key IDs to secrets; tokens are signed with
+    ``active_kid`` and verified with whichever key their kid names, so a
+    new key can be rolled out before the old one is retired.
+    """
+
+    def __init__(self, keys, active_kid):
+        if active_kid not in keys:
+            raise ValueError(f'Unknown signing key id: {active_kid}')
+        self.keys = {kid: secret.encode() if isinstance(secret, str) else secret for kid, secret in keys.items()}
+        self.active_kid = active_kid
+        self.revoked = RevocationList()
+
+    def _signature(self, kid, payload):
+        return _b64encode(hmac.new(self.keys[kid], f'{kid}.{payload}'.encode(), hashlib.sha256).digest())
+
+    def sign(self, user_id, key_code, hwid_hash=None, ttl=TOKEN_TTL):
+        now = int(time.time())
+        claims = {
+            'jti': secrets.token_hex(8),
+            'u': user_id,
+            'k': key_code[:8],
+            'h': hwid_hash,
+            'iat': now,
+            'exp': now + int(ttl)
+        }
+        payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode())
+        return f'{self.active_kid}.{payload}.{self._signature(self.active_kid, payload)}'
+
+    def verify(self, token, hwid_hash=None, now=None):
+        """Return (claims, None) for a good token, else (None, error_code)"""
+        try:
+            kid, payload, signature = token.split('.')
+        except ValueError:
+            return None, 'TOKEN_INVALID'
+        if kid not in self.keys:
+            return None, 'TOKEN_INVALID'
+        # Compared as bytes: compare_digest raises TypeError on non-ASCII str
+        if not hmac.compare_digest(signature.encode(), self._signature(kid, payload).encode()):
+            return None, 'TOKEN_INVALID'
+        try:
+            claims = json.loads(_b64decode(payload))
+        except ValueError:
+            return None, 'TOKEN_INVALID'
+
+        if (now or time.time()) >= claims['exp']:
+            return None, 'TOKEN_EXPIRED'
+        if claims['jti'] in self.revoked:
+            return None, 'TOKEN_REVOKED'
+        if hwid_hash and claims.get('h') and claims['h'] != hwid_hash:
+            return None, 'HWID_MISMATCH'
+        return claims, None
+
+    def stats(self):
+        return {'active_kid': self.active_kid, 'kids': sorted(self.keys), 'revoked': len(self.revoked)}
+
+
+def signer_from_env():
+    """TOKEN_SIGNING_KEYS="kid:secret,kid:secret"; the first key signs. None when unset."""
+    spec = os.environ.get('TOKEN_SIGNING_KEYS', '').strip()
+    if not spec:
+        return None
+    keys = {}
+    for entry in spec.split(','):
+        kid, _, secret = entry.strip().partition(':')
+        if not kid or not secret or '.' in kid:
+            raise ValueError('TOKEN_SIGNING_KEYS entries must look like kid:secret')
+        keys.setdefault(kid, secret)
+    return TokenSigner(keys, os.environ.get('TOKEN_ACTIVE_KID') or spec.split(',')[0].split(':')[0].strip())
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+
+
+class SingleFlight:
+    """Lets concurrent lookups of the same key wait for one in-flight call.
+
+    ``run(key, fn)`` makes the caller the leader for ``key``; callers that
+    ``join(key)`` meanwhile block until it finishes and get its result. A
+    failed call shares None, so followers fall back to their own lookup.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> [done event, result]
+        self.leads = 0
+        self.joins = 0
+
+    def join(self, key):
+        """The in-flight call's result, or None when there is none or it failed"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                return None
+            self.joins += 1
+        call[0].wait()
+        return call[1]
+
+    def run(self, key, fn):
+        with self._lock:
+            if key in self._calls:
+                call = None  # lost the race to another leader; run unshared
+            else:
+                call = self._calls[key] = [threading.Event(), None]
+                self.leads += 1
+        if call is None:
+            return fn()
+        try:
+            call[1] = fn()
+            return call[1]
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call[0].set()
+
+    def stats(self):
+        return {'in_flight': len(self._calls), 'leads': self.leads, 'joins': self.joins}
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines on one event loop"""
+
+    def __init__(self):
+        self._calls = {}  # key -> future
+        self.leads = 0
+        self.joins = 0
+
+    async def join(self, key):
+        """The in-flight call's result, or None when there is none or it failed"""
+        future = self._calls.get(key)
+        if future is None:
+            return None
+        self.joins += 1
+        # Shielded: a cancelled follower must not cancel the future the others wait on
+        return await asyncio.shield(future)
+
+    async def run(self, key, fn):
+        if key in self._calls:
+            return await fn()
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        self.leads += 1
+        result = None
+        try:
+            result = await fn()
+            return result
+        finally:
+            del self._calls[key]
+            future.set_result(result)
+
+    def stats(self):
+        return {'in_flight': len(self._calls), 'leads': self.leads, 'joins': self.joins}
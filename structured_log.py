@@ -0,0 +1,126 @@
+"""JSON logging through a background queue.
+
+Records are formatted and written to stdout by a listener thread, so a
+request only pays for putting the record on a queue. ``get_logger`` sets
+this up on first use; LOG_LEVEL, LOG_FORMAT (json or text) and
+LOG_SUCCESS_SAMPLE tune it.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+
+from notifier import mask_key
+
+SUCCESS_SAMPLE_RATE = float(os.environ.get('LOG_SUCCESS_SAMPLE', 0.01))
+
+_handler = None
+_setup_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        line = f"{self.formatTime(record)} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        if fields:
+            line += ' ' + ' '.join(f'{name}={value}' for name, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queue handler owning its listener; closing it drains the queue first"""
+
+    def __init__(self):
+        super().__init__(queue.SimpleQueue())
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(TextFormatter() if os.environ.get('LOG_FORMAT') == 'text' else JsonFormatter())
+        self.listener = logging.handlers.QueueListener(self.queue, stream)
+        self.listener.start()
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread; keep exc_info and fields intact
+        return record
+
+    def restart(self):
+        """Fresh queue and listener in a forked child; the parent's thread did not survive the fork"""
+        self.queue = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(self.queue, *self.listener.handlers)
+        self.listener.start()
+
+    def close(self):
+        if self.listener._thread is not None:
+            self.listener.stop()
+        super().close()
+
+
+def _setup():
+    global _handler
+    with _setup_lock:
+        if _handler is not None:
+            return
+        _handler = _QueueHandler()
+        root = logging.getLogger()
+        root.addHandler(_handler)
+        root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+        atexit.register(_handler.close)
+
+
+def _restart_after_fork():
+    global _setup_lock
+    _setup_lock = threading.Lock()
+    if _handler is not None:
+        _handler.restart()
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def get_logger(name):
+    _setup()
+    return logging.getLogger(name)
+
+
+def log_validation(logger, key_code, discord_id, result, seconds=None, **fields):
+    """Log a validation outcome: every failure, and a LOG_SUCCESS_SAMPLE fraction of successes.
+
+    RATE_LIMITED answers are sampled like successes; logging each one would
+    let a flooding client flood the logs too.
+    """
+    valid = result.get('valid')
+    sampled = valid or result.get('code') == 'RATE_LIMITED'
+    if sampled and random.random() >= SUCCESS_SAMPLE_RATE:
+        return
+    fields.update({
+        'key': mask_key(key_code) if key_code else None,
+        'discord_id': discord_id,
+        'code': result.get('code')
+    })
+    if seconds is not None:
+        fields['ms'] = round(seconds * 1000, 2)
+    if sampled:
+        fields['sample_rate'] = SUCCESS_SAMPLE_RATE
+    level = logging.INFO if valid or result.get('code') != 'ERROR' else logging.ERROR
+    logger.log(level, 'validation', extra={'fields': fields})
@@ -0,0 +1,19 @@
+"""AsyncAuditWriter backpressure, matching the threaded AuditWriter."""
+import asyncio
+
+from audit_writer import AsyncAuditWriter, audit_record
+
+
+def test_blocked_audit_submit_gives_up_after_block_timeout():
+    async def failing(records):
+        raise OSError('database down')
+
+    async def run():
+        writer = AsyncAuditWriter(failing, max_queue=1, policy='block', block_timeout=0.1, flush_interval=0.01)
+        writer.start()
+        await writer.submit(audit_record('A', None, None, True, 'KEY_VALID'))
+        await asyncio.wait_for(writer.submit(audit_record('B', None, None, True, 'KEY_VALID')), 2)
+        await writer.close(timeout=0.1)
+        return writer
+
+    assert asyncio.run(run()).dropped == 1
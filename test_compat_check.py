@@ -0,0 +1,27 @@
+"""compat_check.comparable: what the two servers must agree on."""
+from compat_check import comparable
+
+
+def _valid(current_uses):
+    return {'valid': True, 'code': 'KEY_VALID', 'message': 'Key is valid', 'data': {
+        'script_name': 'Script', 'discord_id': None, 'expires_at': None,
+        'current_uses': current_uses, 'max_uses': -1
+    }}
+
+
+def test_use_counter_is_ignored():
+    assert comparable('/validate', _valid(4)) == comparable('/validate', _valid(5))
+
+
+def test_contract_fields_still_differ():
+    other = _valid(4)
+    other['data']['script_name'] = 'Other'
+    assert comparable('/validate', _valid(4)) != comparable('/validate', other)
+
+
+def test_health_keeps_status_and_service():
+    first = {'status': 'ok', 'service': 'Terra Hub Key Validator', 'key_cache': {'hits': 1}}
+    second = dict(first, key_cache={'hits': 9})
+    assert comparable('/health', first) == comparable('/health', second) == {
+        'status': 'ok', 'service': 'Terra Hub Key Validator'
+    }
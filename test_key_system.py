@@ -0,0 +1,75 @@
+"""KeySystem against an in-memory pool: the asyncpg paths the validation tests don't reach."""
+import asyncio
+import contextlib
+
+import pytest
+
+from audit_writer import AsyncAuditWriter, audit_record
+from key_system import KeySystem
+
+
+class FakeConnection:
+    def __init__(self):
+        self.copied = []
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.copied.append((table, list(records)))
+
+    async def fetchrow(self, sql, *args):
+        return {'id': 1}
+
+    async def execute(self, sql, *args):
+        return 'DELETE 1' if sql.lstrip().startswith('DELETE') else 'INSERT 0 1'
+
+
+class FakePool:
+    def __init__(self):
+        self.conn = FakeConnection()
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, timeout=None):
+        yield self.conn
+
+
+@pytest.fixture
+def key_system(monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', 'postgresql://localhost/test')
+    monkeypatch.delenv('KEY_CACHE_LISTEN', raising=False)
+
+    def make(listen=False):
+        system = KeySystem(listen=listen)
+        system.pool = FakePool()
+        return system
+    return make
+
+
+def test_audit_flush_writes_through_the_pool(key_system):
+    system = key_system()
+    record = audit_record('KEY', None, None, True, 'KEY_VALID')
+
+    async def run():
+        writer = AsyncAuditWriter(system._write_audit_batch, flush_interval=0.01).start()
+        await writer.submit(record)
+        await writer.close()
+        return writer
+
+    writer = asyncio.run(run())
+    assert system.pool.conn.copied == [('key_validations', [record])]
+    assert writer.written == 1 and writer.failed_flushes == 0
+
+
+def test_listening_create_then_delete_clears_the_filter(key_system):
+    system = key_system(listen=True)
+    system.key_filter.finish_rebuild([])
+
+    async def run():
+        created = await system.create_key('SCRIPT')
+        system._on_key_event(None, 0, 'key_events', f"INSERT:{created['key']}")
+        assert system.key_filter.might_contain(created['key'])
+        assert (await system.delete_key(created['key']))['success']
+        system._on_key_event(None, 0, 'key_events', f"DELETE:{created['key']}")
+        return created['key']
+
+    key_code = asyncio.run(run())
+    assert not system.key_filter.might_contain(key_code)
+    assert system.key_filter.stats()['keys'] == 0
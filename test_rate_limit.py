@@ -0,0 +1,24 @@
+"""limiter_from_env defaults and client IP resolution behind proxies."""
+from rate_limit import limiter_from_env
+
+
+def test_only_ip_is_limited_by_default(monkeypatch):
+    for name in ('RATE_LIMIT', 'RATE_LIMIT_IP', 'RATE_LIMIT_HWID', 'RATE_LIMIT_KEY'):
+        monkeypatch.delenv(name, raising=False)
+    limiter = limiter_from_env()
+    assert limiter.rules['ip'] is not None
+    assert limiter.rules['hwid'] is None and limiter.rules['key'] is None
+
+
+def test_proxy_hops_default_to_one_on_render(monkeypatch):
+    monkeypatch.delenv('RATE_LIMIT_PROXY_HOPS', raising=False)
+    monkeypatch.setenv('RENDER', 'true')
+    limiter = limiter_from_env()
+    assert limiter.client_ip('10.0.0.1', '203.0.113.7, 10.0.0.1') == '10.0.0.1'
+    assert limiter.client_ip('10.0.0.1', '203.0.113.7') == '203.0.113.7'
+
+
+def test_forwarded_for_ignored_without_proxy_hops(monkeypatch):
+    monkeypatch.delenv('RATE_LIMIT_PROXY_HOPS', raising=False)
+    monkeypatch.delenv('RENDER', raising=False)
+    assert limiter_from_env().client_ip('198.51.100.2', '203.0.113.7') == '198.51.100.2'
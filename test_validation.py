@@ -0,0 +1,172 @@
+"""ValidationEngine conformance: the sync and async drivers must agree.
+
+Both drivers run the engine against the same in-memory stand-in for the
+database, which answers LOOKUP like validate_key_atomic, RESERVE like
+reserve_sql and PREFETCH like prefetch_sql.
+"""
+import asyncio
+import copy
+import hashlib
+from datetime import datetime, timedelta
+
+import pytest
+
+from key_cache import KeyCache
+from key_filter import KeyFilter
+from use_counter import UseCounter
+from validation import AUDIT, JOIN, LOOKUP, PREFETCH, RESERVE, ValidationEngine, run_async, run_sync
+
+
+def _key(**fields):
+    key = {'script_name': 'Script', 'expires_at': None, 'discord_id': None, 'hwid_hash': None,
+           'max_uses': -1, 'current_uses': 0, 'is_active': True}
+    key.update(fields)
+    return key
+
+
+KEYS = {
+    'GOOD': _key(),
+    'OLD': _key(expires_at=datetime.now() - timedelta(days=1)),
+    'BOUND': _key(hwid_hash=hashlib.sha256(b'h1').hexdigest()),
+    'ONCE': _key(max_uses=1)
+}
+
+# (key_code, discord_id, hwid) -> expected code, in order against one engine
+CASES = [
+    (('GOOD', None, None), 'KEY_VALID'),
+    (('NOPE', None, None), 'KEY_NOT_FOUND'),
+    (('GHOST', None, None), 'KEY_NOT_FOUND'),  # passes the filter, missing from the table
+    (('OLD', None, None), 'KEY_EXPIRED'),
+    (('BOUND', None, 'h2'), 'HWID_MISMATCH'),
+    (('BOUND', None, 'h1'), 'KEY_VALID'),
+    (('GOOD', 'abc', None), 'INVALID_DISCORD_ID'),
+    (('ONCE', None, None), 'KEY_VALID'),
+    (('ONCE', None, None), 'MAX_USES_EXCEEDED'),
+    (('GOOD', None, 'x'), 'KEY_VALID')
+]
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.keys = copy.deepcopy(KEYS)
+        self.audits = []
+
+    def lookup(self, key_code, discord_id, hwid_hash, now, count_in_db):
+        key = self.keys.get(key_code)
+        if key is None:
+            return {'code': 'KEY_NOT_FOUND'}
+        if not key['is_active']:
+            code = 'KEY_INACTIVE'
+        elif key['expires_at'] is not None and now > key['expires_at']:
+            code = 'KEY_EXPIRED'
+        elif discord_id is not None and key['discord_id'] is not None and key['discord_id'] != discord_id:
+            code = 'DISCORD_ID_MISMATCH'
+        elif hwid_hash and key['hwid_hash'] and key['hwid_hash'] != hwid_hash:
+            code = 'HWID_MISMATCH'
+        elif count_in_db and 0 < key['max_uses'] <= key['current_uses']:
+            code = 'MAX_USES_EXCEEDED'
+        else:
+            code = 'KEY_VALID'
+        if code == 'KEY_VALID':
+            exhausted = 0 < key['max_uses'] <= key['current_uses']
+            if hwid_hash and key['hwid_hash'] is None and not exhausted:
+                key['hwid_hash'] = hwid_hash
+            if count_in_db:
+                key['current_uses'] += 1
+        return dict(key, code=code, key_code=key_code)
+
+    def reserve(self, key_code, size):
+        key = self.keys[key_code]
+        granted = min(size, key['max_uses'] - key['current_uses'])
+        if granted <= 0:
+            return None
+        key['current_uses'] += granted
+        return key['current_uses'], granted
+
+    def perform(self, operation):
+        kind = operation[0]
+        if kind == LOOKUP:
+            return self.lookup(*operation[1:6])
+        if kind == JOIN:
+            return None
+        if kind == RESERVE:
+            return self.reserve(*operation[1:])
+        if kind == PREFETCH:
+            return [dict(self.keys[key_code], key_code=key_code) for key_code in operation[1] if key_code in self.keys]
+        if kind == AUDIT:
+            self.audits.append(operation[1])
+            return None
+        raise AssertionError(f'Unknown operation {operation!r}')
+
+    async def perform_async(self, operation):
+        return self.perform(operation)
+
+
+def _engine(counted_in_memory):
+    key_filter = KeyFilter()
+    key_filter.finish_rebuild(list(KEYS) + ['GHOST'])
+    return ValidationEngine(key_filter, KeyCache(), UseCounter() if counted_in_memory else None)
+
+
+def _drivers(database):
+    return {
+        'sync': lambda operations: run_sync(operations, database.perform),
+        'async': lambda operations: asyncio.run(run_async(operations, database.perform_async))
+    }
+
+
+def _run(driver, counted_in_memory):
+    database = FakeDatabase()
+    engine = _engine(counted_in_memory)
+    run = _drivers(database)[driver]
+    results = [run(engine.validate(*args)) for args, _ in CASES]
+    batch = run(engine.prepare_batch([{'key': 'NOPE'}, {'key': ' GOOD ', 'hwid': ' h '}, 'x', {}]))
+    return results, batch, database
+
+
+@pytest.mark.parametrize('counted_in_memory', [False, True])
+@pytest.mark.parametrize('driver', ['sync', 'async'])
+def test_validate_codes(driver, counted_in_memory):
+    results, _, database = _run(driver, counted_in_memory)
+    assert [result['code'] for result in results] == [code for _, code in CASES]
+    # Every outcome but the malformed Discord ID is audited, then the batch's unknown key
+    audited = [code for _, code in CASES if code != 'INVALID_DISCORD_ID'] + ['KEY_NOT_FOUND']
+    assert [audit[-1] for audit in database.audits] == audited
+
+
+@pytest.mark.parametrize('counted_in_memory', [False, True])
+@pytest.mark.parametrize('driver', ['sync', 'async'])
+def test_valid_result_payload(driver, counted_in_memory):
+    results, _, _ = _run(driver, counted_in_memory)
+    assert results[0]['data'] == {
+        'script_name': 'Script', 'discord_id': None, 'expires_at': None, 'current_uses': 1, 'max_uses': -1
+    }
+    assert results[7]['data']['current_uses'] == 1
+
+
+@pytest.mark.parametrize('counted_in_memory', [False, True])
+def test_exhausted_key_binds_no_hwid(counted_in_memory):
+    database = FakeDatabase()
+    engine = _engine(counted_in_memory)
+    run = _drivers(database)['sync']
+    assert run(engine.validate('ONCE'))['code'] == 'KEY_VALID'
+    assert run(engine.validate('ONCE', hwid='late'))['code'] == 'MAX_USES_EXCEEDED'
+    assert database.keys['ONCE']['hwid_hash'] is None
+
+
+@pytest.mark.parametrize('counted_in_memory', [False, True])
+@pytest.mark.parametrize('driver', ['sync', 'async'])
+def test_prepare_batch(driver, counted_in_memory):
+    _, (results, pending), _ = _run(driver, counted_in_memory)
+    assert [result and result['code'] for result in results] == ['KEY_NOT_FOUND', None, 'INVALID_ITEM', 'MISSING_KEY']
+    assert pending == [(1, 'GOOD', None, 'h')]
+
+
+@pytest.mark.parametrize('counted_in_memory', [False, True])
+def test_drivers_agree(counted_in_memory):
+    sync_results, sync_batch, sync_database = _run('sync', counted_in_memory)
+    async_results, async_batch, async_database = _run('async', counted_in_memory)
+    assert sync_results == async_results
+    assert sync_batch == async_batch
+    assert sync_database.keys == async_database.keys
+    assert [audit[-2:] for audit in sync_database.audits] == [audit[-2:] for audit in async_database.audits]
@@ -0,0 +1,151 @@
+import asyncio
+import os
+import secrets
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from structured_log import get_logger
+
+log = get_logger('token_store')
+
+TOKEN_TTL = 1800  # 30 minutes, as promised in the ?validate DM
+
+
+class TokenStore:
+    """Executor tokens issued by ?validate, expiring after ``ttl`` seconds.
+
+    Every token lives for the same ``ttl``, so insertion order is expiry
+    order: the OrderedDict front is always the next token to expire, which
+    makes sweeping and size-cap eviction O(1) per token. Past ``max_size``
+    the oldest tokens are evicted early.
+
+    With a connection factory attached, tokens are also written to the
+    UNLOGGED validation_tokens table so they survive a restart and other
+    processes can verify them.
+    """
+
+    def __init__(self, ttl=TOKEN_TTL, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.connection = None  # () -> async context manager yielding a connection
+        self._tokens = OrderedDict()
+        self._sweep_task = None
+        self.issued = 0
+        self.expired = 0
+        self.evicted = 0
+
+    async def attach(self, connection):
+        """Persist tokens through connections from ``connection()`` and load the ones still valid"""
+        self.connection = connection
+        async with connection() as conn:
+            await conn.execute('DELETE FROM validation_tokens WHERE expires_at <= $1', datetime.now())
+            rows = await conn.fetch('''
+                SELECT token, user_id, key_prefix, issued_at
+                FROM validation_tokens
+                ORDER BY issued_at
+            ''')
+        for row in rows:
+            self._insert(row['token'], {
+                'user_id': row['user_id'],
+                'key': row['key_prefix'],
+                'timestamp': row['issued_at'].timestamp()
+            })
+
+    def _insert(self, token, entry):
+        self._tokens[token] = entry
+        while len(self._tokens) > self.max_size:
+            self._tokens.popitem(last=False)
+            self.evicted += 1
+
+    async def issue(self, user_id, key_code):
+        token = secrets.token_hex(16).upper()
+        entry = {'user_id': user_id, 'key': key_code[:8], 'timestamp': time.time()}
+        self._insert(token, entry)
+        self.issued += 1
+        if self.connection:
+            issued_at = datetime.fromtimestamp(entry['timestamp'])
+            async with self.connection() as conn:
+                await conn.execute('''
+                    INSERT INTO validation_tokens (token, user_id, key_prefix, issued_at, expires_at)
+                    VALUES ($1, $2, $3, $4, $5)
+                ''', token, user_id, entry['key'], issued_at, issued_at + timedelta(seconds=self.ttl))
+        return token
+
+    def get(self, token):
+        """The token's entry, or None if it is unknown or expired"""
+        entry = self._tokens.get(token)
+        if entry is None:
+            return None
+        if time.time() - entry['timestamp'] >= self.ttl:
+            del self._tokens[token]
+            self.expired += 1
+            return None
+        return entry
+
+    async def consume(self, token):
+        """Return the token's entry and revoke it, so it verifies only once"""
+        entry = self.get(token)
+        if entry is None:
+            return None
+        del self._tokens[token]
+        if self.connection:
+            async with self.connection() as conn:
+                deleted = await conn.fetchval('DELETE FROM validation_tokens WHERE token = $1 RETURNING 1', token)
+            if deleted is None:
+                return None  # already consumed by another process
+        return entry
+
+    def sweep(self):
+        """Drop expired tokens from the front; returns how many were dropped"""
+        cutoff = time.time() - self.ttl
+        dropped = 0
+        while self._tokens:
+            token, entry = next(iter(self._tokens.items()))
+            if entry['timestamp'] > cutoff:
+                break
+            self._tokens.popitem(last=False)
+            dropped += 1
+        self.expired += dropped
+        return dropped
+
+    async def _sweep_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+            if self.connection:
+                try:
+                    async with self.connection() as conn:
+                        await conn.execute('DELETE FROM validation_tokens WHERE expires_at <= $1', datetime.now())
+                except Exception as e:
+                    log.error('Token sweep failed', extra={'fields': {'error': str(e)}})
+
+    def start(self, interval=60.0):
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop(interval))
+        return self
+
+    def close(self):
+        if self._sweep_task:
+            self._sweep_task.cancel()
+            self._sweep_task = None
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def stats(self):
+        return {
+            'size': len(self._tokens),
+            'max_size': self.max_size,
+            'issued': self.issued,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'persistent': self.connection is not None
+        }
+
+
+def token_store_from_env():
+    return TokenStore(
+        ttl=float(os.environ.get('TOKEN_TTL', TOKEN_TTL)),
+        max_size=int(os.environ.get('TOKEN_STORE_SIZE', 100000))
+    )
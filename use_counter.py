@@ -0,0 +1,147 @@
+import os
+import threading
+import time
+
+# Reserve up to $2 uses of a limited key. The row lock keeps concurrent
+# reservations from different processes from over-granting.
+RESERVE_SQL = '''
+    WITH k AS (
+        SELECT id, current_uses, max_uses
+        FROM keys
+        WHERE key_code = {0} AND max_uses > 0
+        FOR UPDATE
+    )
+    UPDATE keys
+    SET current_uses = k.current_uses + LEAST({1}, k.max_uses - k.current_uses)
+    FROM k
+    WHERE keys.id = k.id AND k.current_uses < k.max_uses
+    RETURNING keys.current_uses AS end_use, LEAST({1}, k.max_uses - k.current_uses) AS granted
+'''
+
+
+def reserve_sql(style='format'):
+    if style == 'numeric':
+        return RESERVE_SQL.format('$1', '$2::integer')
+    return RESERVE_SQL.format('%s', '%s')
+
+
+def flush_sql(count, style='format'):
+    """One UPDATE ... FROM (VALUES ...) applying ``count`` (key_code, delta) pairs"""
+    if style == 'numeric':
+        rows = ', '.join(f'(${i * 2 + 1}::varchar, ${i * 2 + 2}::integer)' for i in range(count))
+    else:
+        rows = ', '.join(['(%s, %s)'] * count)
+    return f'''
+        UPDATE keys
+        SET current_uses = keys.current_uses + v.delta
+        FROM (VALUES {rows}) AS v(key_code, delta)
+        WHERE keys.key_code = v.key_code
+    '''
+
+
+class UseCounter:
+    """In-memory keys.current_uses accounting flushed to the database in bulk.
+
+    Unlimited keys (max_uses <= 0) just accumulate a delta. Limited keys draw
+    from quota blocks reserved up front with RESERVE_SQL, so max_uses can never
+    be exceeded across processes. Block sizes start at one use and double while
+    a key stays busy; quota left idle for ``idle_release`` seconds is handed
+    back so other processes can use it.
+    """
+
+    def __init__(self, max_block=64, idle_release=5.0):
+        self.max_block = max_block
+        self.idle_release = idle_release
+        self._lock = threading.Lock()
+        self._deltas = {}
+        self._known = {}
+        self._blocks = {}
+        self.flushes = 0
+        self.reservations = 0
+
+    def record_unlimited(self, key_code, known_uses=None):
+        """Count one use of an unlimited key; returns the estimated current_uses"""
+        with self._lock:
+            if known_uses is not None:
+                self._known[key_code] = known_uses - self._deltas.get(key_code, 0)
+            self._deltas[key_code] = self._deltas.get(key_code, 0) + 1
+            return self._known.get(key_code, 0) + self._deltas[key_code]
+
+    def take(self, key_code):
+        """Use one reserved unit of a limited key; None means a reservation is needed"""
+        with self._lock:
+            block = self._blocks.get(key_code)
+            if block is None or block['remaining'] <= 0:
+                return None
+            use_number = block['next']
+            block['next'] += 1
+            block['remaining'] -= 1
+            block['touched'] = time.monotonic()
+            return use_number
+
+    def reserve_size(self, key_code):
+        with self._lock:
+            block = self._blocks.get(key_code)
+            return block['size'] if block else 1
+
+    def add_block(self, key_code, end_use, granted):
+        with self._lock:
+            block = self._blocks.get(key_code)
+            if block is None or block['remaining'] <= 0:
+                size = min((block['size'] if block else 1) * 2, self.max_block)
+                block = {'next': end_use - granted + 1, 'remaining': 0, 'size': size}
+                self._blocks[key_code] = block
+            block['remaining'] += granted
+            block['touched'] = time.monotonic()
+            self.reservations += 1
+
+    def forget(self, key_code):
+        """Drop local state for a deleted key"""
+        with self._lock:
+            self._deltas.pop(key_code, None)
+            self._known.pop(key_code, None)
+            self._blocks.pop(key_code, None)
+
+    def drain(self, release_all=False):
+        """Take the pending (key_code, delta) pairs, returning idle quota as negative deltas"""
+        now = time.monotonic()
+        with self._lock:
+            deltas = self._deltas
+            self._deltas = {}
+            for key_code, delta in deltas.items():
+                if key_code in self._known:
+                    self._known[key_code] += delta
+            for key_code, block in list(self._blocks.items()):
+                if release_all or now - block['touched'] > self.idle_release:
+                    if block['remaining']:
+                        deltas[key_code] = deltas.get(key_code, 0) - block['remaining']
+                    del self._blocks[key_code]
+            # Sorted so concurrent flushers lock rows in the same order
+            return sorted((key_code, delta) for key_code, delta in deltas.items() if delta)
+
+    def restore(self, pairs):
+        """Put back deltas whose flush failed so the next flush retries them"""
+        with self._lock:
+            for key_code, delta in pairs:
+                self._deltas[key_code] = self._deltas.get(key_code, 0) + delta
+                if key_code in self._known:
+                    self._known[key_code] -= delta
+
+    def stats(self):
+        return {
+            'pending_keys': len(self._deltas),
+            'reserved_keys': len(self._blocks),
+            'reserved_uses': sum(block['remaining'] for block in self._blocks.values()),
+            'reservations': self.reservations,
+            'flushes': self.flushes
+        }
+
+
+def counter_from_env():
+    """A UseCounter when write-behind is enabled (the default), otherwise None"""
+    if os.environ.get('USE_COUNTER_WRITE_BEHIND', '1') in ('0', 'false', 'no'):
+        return None
+    return UseCounter(
+        max_block=int(os.environ.get('USE_QUOTA_MAX_BLOCK', 64)),
+        idle_release=float(os.environ.get('USE_QUOTA_IDLE_RELEASE', 5))
+    )
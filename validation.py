@@ -0,0 +1,218 @@
+"""Key validation engine shared by app.py (pg8000, threads) and KeySystem (asyncpg).
+
+The checks are written once as generators that never do I/O themselves:
+they yield an operation tuple whenever they need the database, the audit
+writer or an in-flight lookup, and get the answer back from ``send``.
+Each server supplies a driver that performs the operations with its own
+transport, run through ``run_sync`` or ``run_async``:
+
+    (LOOKUP, key_code, discord_id, hwid_hash, now, count_in_db, lead)
+        -> validate_key_atomic row; ``lead`` asks for it to be shared
+           with concurrent validations of the key (single-flight)
+    (JOIN, key_code)      -> the in-flight lookup's row, or None
+    (RESERVE, key_code, size) -> reserve_sql row (end_use, granted), or None
+    (PREFETCH, key_codes) -> prefetch_sql rows
+    (AUDIT, record)       -> None
+"""
+import hashlib
+from datetime import datetime
+
+from audit_writer import audit_record
+from key_cache import check_cached_key
+
+VALIDATION_MESSAGES = {
+    'KEY_VALID': 'Key is valid',
+    'KEY_NOT_FOUND': 'Invalid key',
+    'KEY_INACTIVE': 'Key is inactive',
+    'KEY_EXPIRED': 'Key has expired',
+    'DISCORD_ID_MISMATCH': 'Key bound to different user',
+    'HWID_MISMATCH': 'Key bound to different device',
+    'MAX_USES_EXCEEDED': 'Key usage limit exceeded',
+    'SERVICE_UNAVAILABLE': 'Key validation is temporarily unavailable, try again shortly'
+}
+
+LOOKUP = 'lookup'
+JOIN = 'join'
+RESERVE = 'reserve'
+PREFETCH = 'prefetch'
+AUDIT = 'audit'
+
+
+def parse_discord_id(discord_id):
+    """Coerce a Discord ID from JSON (int or numeric string) to int, or None"""
+    if discord_id is None or discord_id == '':
+        return None
+    if isinstance(discord_id, bool):
+        raise ValueError('Invalid Discord ID')
+    return int(discord_id)
+
+
+def hash_hwid(hwid):
+    if hwid:
+        return hashlib.sha256(hwid.encode()).hexdigest()
+    return None
+
+
+def failure(code):
+    return {'valid': False, 'code': code, 'message': VALIDATION_MESSAGES[code]}
+
+
+class ValidationEngine:
+    """The validation checks over a key filter, key cache and optional write-behind use counter.
+
+    ``cache_trusted`` says whether cached entries may be used right now;
+    app.py only trusts them while its key_events feed is delivering
+    invalidations.
+    """
+
+    def __init__(self, key_filter, key_cache, use_counter=None, cache_trusted=None):
+        self.key_filter = key_filter
+        self.key_cache = key_cache
+        self.use_counter = use_counter
+        self.cache_trusted = cache_trusted or (lambda: True)
+
+    def _cached(self, key_code):
+        return self.key_cache.get(key_code) if self.cache_trusted() else None
+
+    def _reject(self, key_code, discord_id, hwid_hash, code):
+        yield (AUDIT, audit_record(key_code, discord_id, hwid_hash, False, code))
+        return failure(code)
+
+    def validate(self, key_code, discord_id=None, hwid=None):
+        try:
+            discord_id = parse_discord_id(discord_id)
+        except ValueError:
+            return {'valid': False, 'code': 'INVALID_DISCORD_ID', 'message': 'Discord ID must be numeric'}
+
+        hwid_hash = hash_hwid(hwid)
+        if not self.key_filter.might_contain(key_code):
+            return (yield from self._reject(key_code, discord_id, hwid_hash, 'KEY_NOT_FOUND'))
+
+        now = datetime.now()
+        cached = self._cached(key_code)
+        if cached is None:
+            # Another validation of this key is already querying it: wait and reuse what it cached
+            shared = yield (JOIN, key_code)
+            if shared is not None:
+                if shared['code'] == 'KEY_NOT_FOUND':
+                    return (yield from self._reject(key_code, discord_id, hwid_hash, 'KEY_NOT_FOUND'))
+                cached = self._cached(key_code)
+        if cached is not None:
+            code = check_cached_key(cached, discord_id, hwid_hash, now)
+            if code:
+                return (yield from self._reject(key_code, discord_id, hwid_hash, code))
+
+        count_in_db = self.use_counter is None
+        if cached is not None and not count_in_db and not (hwid_hash and cached['hwid_hash'] is None):
+            # Nothing to bind and uses are counted in memory: no database work
+            record = cached
+            known_uses = None
+        else:
+            epoch = self.key_cache.epoch()
+            record = yield (LOOKUP, key_code, discord_id, hwid_hash, now, count_in_db, cached is None)
+
+            code = record['code']
+            if code == 'KEY_NOT_FOUND':
+                if self.key_filter.ready:
+                    self.key_filter.record_false_positive()
+            else:
+                self.key_cache.put(key_code, record, epoch)
+
+            if code != 'KEY_VALID':
+                return (yield from self._reject(key_code, discord_id, hwid_hash, code))
+            known_uses = record['current_uses']
+
+        current_uses = known_uses if count_in_db else (yield from self._count_use(key_code, record['max_uses'], known_uses))
+        if current_uses is None:
+            return (yield from self._reject(key_code, discord_id, hwid_hash, 'MAX_USES_EXCEEDED'))
+
+        yield (AUDIT, audit_record(key_code, discord_id, hwid_hash, True, 'KEY_VALID'))
+        return {
+            'valid': True,
+            'code': 'KEY_VALID',
+            'message': VALIDATION_MESSAGES['KEY_VALID'],
+            'data': {
+                'script_name': record['script_name'],
+                'discord_id': record['discord_id'],
+                'expires_at': record['expires_at'].isoformat() if record['expires_at'] else None,
+                'current_uses': current_uses,
+                'max_uses': record['max_uses']
+            }
+        }
+
+    def _count_use(self, key_code, max_uses, known_uses):
+        """Count a use in the write-behind counter; None when max_uses is exhausted"""
+        if max_uses <= 0:
+            return self.use_counter.record_unlimited(key_code, known_uses)
+
+        use_number = self.use_counter.take(key_code)
+        while use_number is None:
+            row = yield (RESERVE, key_code, self.use_counter.reserve_size(key_code))
+            if row is None:
+                return None
+            self.use_counter.add_block(key_code, row[0], row[1])
+            use_number = self.use_counter.take(key_code)
+        return use_number
+
+    def prepare_batch(self, items):
+        """Settle what a batch can without per-key lookups.
+
+        Cache misses are resolved with one PREFETCH first, so unknown keys
+        are rejected here. Returns (results, pending): results in item order
+        with None for every item still to validate, and pending as
+        (index, key_code, discord_id, hwid) for the driver to validate.
+        """
+        key_codes = {(item.get('key') or '').strip() for item in items if isinstance(item, dict)}
+        key_codes.discard('')
+        misses = [key_code for key_code in key_codes if self.key_cache.get(key_code) is None]
+        missing = set()
+        if misses:
+            epoch = self.key_cache.epoch()
+            rows = yield (PREFETCH, misses)
+            for row in rows:
+                self.key_cache.put(row['key_code'], row, epoch)
+            missing = set(misses) - {row['key_code'] for row in rows}
+
+        results = []
+        pending = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                results.append({'valid': False, 'code': 'INVALID_ITEM', 'message': 'Item must be an object'})
+                continue
+            key_code = (item.get('key') or '').strip()
+            discord_id = item.get('discord_id')
+            hwid = item.get('hwid')
+            hwid = hwid.strip() if isinstance(hwid, str) else hwid
+            if not key_code:
+                results.append({'valid': False, 'code': 'MISSING_KEY', 'message': 'Key is required'})
+            elif key_code in missing:
+                try:
+                    discord_id = parse_discord_id(discord_id)
+                except ValueError:
+                    results.append({'valid': False, 'code': 'INVALID_DISCORD_ID', 'message': 'Discord ID must be numeric'})
+                    continue
+                results.append((yield from self._reject(key_code, discord_id, hash_hwid(hwid), 'KEY_NOT_FOUND')))
+            else:
+                results.append(None)
+                pending.append((index, key_code, discord_id, hwid))
+        return results, pending
+
+
+def run_sync(operations, perform):
+    """Drive an engine generator, answering each operation with ``perform(operation)``"""
+    try:
+        operation = next(operations)
+        while True:
+            operation = operations.send(perform(operation))
+    except StopIteration as done:
+        return done.value
+
+
+async def run_async(operations, perform):
+    """``run_sync`` for drivers whose ``perform`` is a coroutine function"""
+    try:
+        operation = next(operations)
+        while True:
+            operation = operations.send(await perform(operation))
+    except StopIteration as done:
+        return done.value